@@ -0,0 +1,89 @@
+"""
+benchmarks of the dispatch of the AMoD system
+"""
+
+import io
+import copy
+import time
+import pickle
+import tracemalloc
+import argparse
+import contextlib
+
+from lib.OsrmEngine import *
+from lib.Agents import *
+from lib.Demand import *
+from lib.Constants import *
+
+
+# dispatch a model for T seconds with the insertion heuristics only, and return the run time and the model
+def run_insertion(osrm, V, T, n_worker, seed):
+	np.random.seed(seed)
+	model = Model(DMD_MAT, DMD_VOL, V=V, K=VEH_CAPACITY, assign="ins", reopt="no", rebl="no", n_worker=n_worker)
+	stime = time.time()
+	with contextlib.redirect_stdout(io.StringIO()):
+		for t in range(0, T, INT_ASSIGN):
+			model.dispatch_at_time(osrm, t)
+	runtime = time.time() - stime
+	if model.pool is not None:
+		model.pool.shutdown()
+	return runtime, model
+
+
+# dispatch a model for T seconds, and return the memory held by its vehicles and requests at the end (in bytes),
+# the time to deep copy its vehicles, and the numbers of requests and of steps on the routes of the vehicles
+def run_memory(osrm, V, T, seed):
+	np.random.seed(seed)
+	model = Model(DMD_MAT, DMD_VOL, V=V, K=VEH_CAPACITY, assign="ins", reopt="no", rebl="orp")
+	with contextlib.redirect_stdout(io.StringIO()):
+		for t in range(0, T, INT_ASSIGN):
+			model.dispatch_at_time(osrm, t)
+	n_step = sum(len(leg.steps) for veh in model.vehs for leg in veh.route)
+	stime = time.time()
+	copy.deepcopy(model.vehs)
+	copytime = time.time() - stime
+	# the memory of the vehicles and requests is what is freed when they are rebuilt from a pickle and dropped
+	state = pickle.dumps((model.vehs, model.reqs))
+	tracemalloc.start()
+	vehs, reqs = pickle.loads(state)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return size, copytime, len(reqs), n_step
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="speedup of the parallel insertion heuristics against the number of workers, or memory of the model")
+	parser.add_argument("--fleet", type=int, default=1000, help="number of vehicles")
+	parser.add_argument("--time", type=int, default=None, help="simulated time (in seconds), by default 30 minutes, or a full day with --memory")
+	parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of worker processes")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the random generators")
+	parser.add_argument("--memory", action="store_true", help="measure the memory held by the vehicles and requests instead")
+	args = parser.parse_args()
+	if args.time is None:
+		args.time = 60*60*24 if args.memory else 60*30
+
+	# path of the routing server
+	exe_loc = './osrm-backend-5.11.0/build/osrm-routed'
+	# path of the road network file that the routing server uses
+	map_loc = './osrm-backend-5.11.0/boston_massachusetts.osm.pbf'
+
+	osrm = OsrmEngine(exe_loc, map_loc)
+	if IS_ROAD_ENABLED:
+		osrm.start_server()
+
+	if args.memory:
+		size, copytime, n_req, n_step = run_memory(osrm, args.fleet, args.time, args.seed)
+		print("%d vehicles, %d requests, %d steps: %.1f MB, %.1f bytes per request, deep copy of the vehicles in %.2f s" % (
+			args.fleet, n_req, n_step, size/1e6, size/max(n_req, 1), copytime))
+	else:
+		base = None
+		for n_worker in args.workers:
+			runtime, model = run_insertion(osrm, args.fleet, args.time, n_worker, args.seed)
+			# the parallel insertion heuristics assign the same vehicles at the same times as the serial one
+			result = [(req.Tp, req.Td) for req in model.reqs]
+			if base is None:
+				base = (runtime, result)
+			print("%d workers: %.2f s, speedup %.2f, %d requests, %d rejected, same result: %s" % (
+				n_worker, runtime, base[0]/runtime, len(model.reqs), len(model.rejs), result == base[1]))
+
+	osrm.kill_server()
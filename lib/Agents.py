@@ -8,22 +8,47 @@ import math
 from collections import deque
 import matplotlib.pyplot as plt
 import itertools
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from lib.Demand import *
 from lib.Constants import *
 
+# get the cumulative length of a geometry at each of its points, in degrees as the vehicles interpolate their locations
+def get_cumulative_length(geo):
+    cum = np.zeros(len(geo))
+    if len(geo) > 1:
+        cum[1:] = np.cumsum( np.sqrt( np.sum( np.diff(geo, axis=0)**2, axis=1) ) )
+    return cum
+
+
 class Step(object):
     """ 
     Step is a class for steps in a leg
     Attributes:
         d: distance 
         t: duration
-        geo: geometry, a list of coordinates
+        geo: geometry, an n x 2 array of coordinates, which may be a view of the geometry of the whole leg
+        cum: cumulative length of the geometry at each of its points, from an arbitrary origin
     """
-    def __init__(self, d=0.0, t=0.0, geo=[]):
+    __slots__ = ["d", "t", "geo", "cum"]
+    def __init__(self, d=0.0, t=0.0, geo=[], cum=None):
         self.d = d
         self.t = t
-        self.geo = geo
+        self.geo = np.asarray(geo, dtype=float).reshape(-1, 2)
+        self.cum = get_cumulative_length(self.geo) if cum is None else cum
+
+    # locate the point at a fraction pct of the length left of the step
+    # return the index k of the segment from point k to point k+1 it is on, its cumulative length and its coordinates
+    def locate(self, pct):
+        cum = self.cum
+        s = cum[0] + pct * (cum[-1] - cum[0])
+        # the segment is the first one that ends beyond the point
+        k = min(int(np.searchsorted(cum, s, side="right")) - 1, len(cum) - 2)
+        seg = cum[k+1] - cum[k]
+        _pct = (s - cum[k]) / seg if seg > 0 else 0.0
+        return k, s, self.geo[k] + _pct * (self.geo[k+1] - self.geo[k])
         
     def __str__(self):
         return "step: distance = %.1f, duration = %.1f" % (self.d, self.t)
@@ -42,6 +67,7 @@ class Leg(object):
         t: total duration
         steps: a list of steps
     """
+    __slots__ = ["rid", "pod", "tlng", "tlat", "d", "t", "steps"]
     def __init__(self, rid, pod, tlng, tlat, d=0.0, t=0.0, steps=[]):
         self.rid = rid
         self.pod = pod
@@ -55,6 +81,49 @@ class Leg(object):
         return "leg: distance = %.1f, duration = %.1f, number of steps = %d" % (self.d, self.t, len(self.steps) )
     
 
+class Sched(object):
+    """ 
+    Sched is a class for the schedule of a route, based on a table of durations between its stops
+    Stop 0 is the current location of the vehicle, and stops 1 to l are the stops of the route
+    The slack of a stop is the delay of its arrival it can absorb before it is late
+    Attributes:
+        stops: the quadruples (rid, pod, tlng, tlat) of the route
+        locs: locations of the stops
+        t: arrival times at the stops, relative to the vehicle time
+        n: loads after the stops
+        c: prefix costs of the route up to the stops
+        a: slack of the stops with a fixed deadline, i.e. pickups and dropoffs of passengers on board
+        r: slack of the dropoffs of requests picked up on the route, relative to their pickups
+        bad: first stop that is late, l+1 if none
+        K: maximum load on the route
+        sw: suffix sums of the weights of the arrival times in the cost
+        amin: suffix minima of a
+        ain: ain[i][j] is the minimum of a over stops i+1 to j
+        rin: rin[i][j] is the minimum of r over stops i+1 to j picked up up to stop i
+        rout: rout[i][j] is the minimum of r over stops after j picked up up to stop i
+        nin: nin[i][j] is the maximum load after stops i to j
+    """
+    def __init__(self, l):
+        self.stops = []
+        self.locs = []
+        self.t = [0.0] * (l+1)
+        self.n = [0] * (l+1)
+        self.c = [0.0] * (l+1)
+        self.a = [np.inf] * (l+1)
+        self.r = [np.inf] * (l+1)
+        self.bad = l+1
+        self.K = 0
+        self.sw = [0.0] * (l+2)
+        self.amin = [np.inf] * (l+2)
+        self.ain = [[np.inf] * (l+1) for i in range(l+1)]
+        self.rin = [[np.inf] * (l+1) for i in range(l+1)]
+        self.rout = [[np.inf] * (l+1) for i in range(l+1)]
+        self.nin = [[0] * (l+1) for i in range(l+1)]
+        
+    def __str__(self):
+        return "sched: number of stops = %d, duration = %.1f, cost = %.1f" % (len(self.t)-1, self.t[-1], self.c[-1])
+
+
 class Veh(object):
     """ 
     Veh is a class for vehicles
@@ -78,16 +147,25 @@ class Veh(object):
         Ts: accumulated service time traveled
         Dr: accumulated rebalancing distance traveled
         Tr: accumulated rebalancing time traveled
+        sched: schedule of the route at the current state, None if not known
+        tl: timeline of the route as defined in class Fleet, None if not built yet
         Lt: accumulated load, weighed by service time
         Ld: accumulated load, weighed by service distance
     """ 
-    def __init__(self, id, rs, K=4, S=6, T=0.0):
+    __slots__ = ["id", "idle", "rebl", "T", "lat", "lng", "tlat", "tlng", "K", "S", "n", "route", "t", "d", "c",
+                 "Ds", "Ts", "Dr", "Tr", "sched", "tl", "Lt", "Ld"]
+    def __init__(self, id, rs, K=4, S=6, T=0.0, lng=None, lat=None):
         self.id = id
         self.idle = True
         self.rebl = False
         self.T = T
-        self.lng = (Olng+Dlng)/2 + (Dlng-Olng)*rs.uniform(-0.35, 0.35) 
-        self.lat = (Olat+Dlat)/2 + (Dlat-Olat)*rs.uniform(-0.35, 0.35)
+        # the vehicle is placed at random in the center of the map unless a location is given
+        if lng is None or lat is None:
+            self.lng = (Olng+Dlng)/2 + (Dlng-Olng)*rs.uniform(-0.35, 0.35) 
+            self.lat = (Olat+Dlat)/2 + (Dlat-Olat)*rs.uniform(-0.35, 0.35)
+        else:
+            self.lng = lng
+            self.lat = lat
         self.tlng = self.lng
         self.tlat = self.lat
         self.K = K
@@ -103,6 +181,8 @@ class Veh(object):
         self.Tr = 0.0
         self.Lt = 0.0
         self.Ld = 0.0
+        self.sched = None
+        self.tl = None
         
     def get_location(self):
         return (self.lng, self.lat)
@@ -110,10 +190,12 @@ class Veh(object):
     def get_target_location(self):
         return (self.tlng, self.tlat)
     
-    def jump_to_location(self, lng, lat):
-        self.lng = lng
-        self.lat = lat
-    
+    # get a copy of the vehicle with the stops of its route, but without their steps
+    def get_stop_copy(self):
+        veh = copy.copy(self)
+        veh.route = deque([Leg(leg.rid, leg.pod, leg.tlng, leg.tlat, leg.d, leg.t) for leg in self.route])
+        return veh
+
     # build the route of the vehicle based on a series of quadruples (rid, pod, tlng, tlat)
     # update t, d, c, idle, rebl accordingly
     # rid, pod, tlng, tlat are defined as in class Leg
@@ -128,8 +210,14 @@ class Veh(object):
             self.c = 0.0
             return 
         else:
-            for (rid, pod, tlng, tlat) in route:
-                self.add_leg(osrm, rid, pod, tlng, tlat, reqs, T)
+            # route through all stops in a single call, and fall back to one call per leg if it fails
+            legs = None
+            if IS_ROAD_ENABLED:
+                coords = [(self.tlng, self.tlat)]
+                coords.extend( (tlng, tlat) for (rid, pod, tlng, tlat) in route )
+                legs = osrm.get_route_legs(coords)
+            for k, (rid, pod, tlng, tlat) in enumerate(route):
+                self.add_leg(osrm, rid, pod, tlng, tlat, reqs, T, legs[k] if legs is not None else None)
         # if rid is -1, vehicle is rebalancing
         if self.route[0].rid == -1:
             self.idle = True
@@ -151,8 +239,79 @@ class Veh(object):
             assert n == 0
             self.c = c
         
+    # get the schedule of the route based on a series of quadruples (rid, pod, tlng, tlat) and a table of durations
+    # the schedule is kept until the vehicle moves or its route changes
+    # return None if the route serves in-advance requests, as the waits for their pickups absorb delays,
+    # or if there is no table of durations (the routing server failed)
+    def get_schedule(self, route, reqs, durs):
+        if durs is None:
+            return None
+        # the schedule is rebuilt if it is of another route, or if the table does not agree with it,
+        # as durations from different calls may differ
+        if self.sched is not None and self.sched.stops == route:
+            t = 0.0
+            for k in range(1, len(route)+1):
+                t += durs[self.sched.locs[k-1] + self.sched.locs[k]]
+                if t != self.sched.t[k]:
+                    break
+            else:
+                return self.sched
+        for (rid, pod, tlng, tlat) in route:
+            if not reqs[rid].OnD:
+                return None
+        l = len(route)
+        T = self.T
+        sched = Sched(l)
+        sched.stops = list(route)
+        sched.locs.append( (self.lng, self.lat) )
+        sched.n[0] = self.n
+        sched.K = self.n
+        w = [0.0] * (l+2)
+        p = [l+1] * (l+1)
+        picked = {}
+        for k, (rid, pod, tlng, tlat) in enumerate(route, 1):
+            req = reqs[rid]
+            sched.locs.append( (tlng, tlat) )
+            dt = durs[sched.locs[k-1] + sched.locs[k]]
+            sched.t[k] = sched.t[k-1] + dt
+            # the same operations as in Model.test_constraints_get_cost(), so that the results are identical
+            if pod == 1:
+                picked[rid] = k
+                late = T + sched.t[k] > req.Clp
+                sched.a[k] = req.Clp - T - sched.t[k]
+                w[k] = COEF_WAIT - COEF_INVEH
+            else:
+                if rid in picked:
+                    p[k] = picked[rid]
+                    late = T + sched.t[k] > T + sched.t[p[k]] + MAX_DETOUR * req.Ts
+                    sched.r[k] = MAX_DETOUR * req.Ts - (sched.t[k] - sched.t[p[k]])
+                else:
+                    late = T + sched.t[k] > req.Cld
+                    sched.a[k] = req.Cld - T - sched.t[k]
+                w[k] = COEF_INVEH
+            if late and sched.bad > l:
+                sched.bad = k
+            sched.c[k] = sched.c[k-1] + sched.n[k-1] * dt * COEF_INVEH + (sched.t[k] * COEF_WAIT if pod == 1 else 0)
+            sched.n[k] = sched.n[k-1] + pod
+            sched.K = max(sched.K, sched.n[k])
+        for k in range(l, 0, -1):
+            sched.sw[k] = sched.sw[k+1] + w[k]
+            sched.amin[k] = min(sched.a[k], sched.amin[k+1])
+        for i in range(l+1):
+            sched.nin[i][i] = sched.n[i]
+            for j in range(i+1, l+1):
+                sched.nin[i][j] = max(sched.nin[i][j-1], sched.n[j])
+                sched.ain[i][j] = min(sched.ain[i][j-1], sched.a[j])
+                sched.rin[i][j] = min(sched.rin[i][j-1], sched.r[j] if p[j] <= i else np.inf)
+            for j in range(l-1, i-1, -1):
+                sched.rout[i][j] = min(sched.rout[i][j+1], sched.r[j+1] if p[j+1] <= i else np.inf)
+        self.sched = sched
+        return sched
+
     # remove the current route    
     def clear_route(self):
+        self.sched = None
+        self.tl = None
         self.route.clear()
         self.d = 0.0
         self.t = 0.0
@@ -161,20 +320,28 @@ class Veh(object):
         self.tlat = self.lat
     
     # add a leg based on (rid, pod, tlng, tlat)
-    def add_leg(self, osrm, rid, pod, tlng, tlat, reqs, T):
+    # l is the leg returned by the routing server if already known, otherwise it is requested here
+    def add_leg(self, osrm, rid, pod, tlng, tlat, reqs, T, l=None):
         if IS_ROAD_ENABLED:
-            l = osrm.get_routing(self.tlng, self.tlat, tlng, tlat)
+            if l is None:
+                l = osrm.get_routing(self.tlng, self.tlat, tlng, tlat)
             leg = Leg(rid, pod, tlng, tlat, 
                       l['distance'], l['duration'], steps=[])
+            # the geometry of all steps and its cumulative length are stored in single arrays, of which each step keeps views
+            geo = np.array([c for s in l['steps'] for c in s['geometry']['coordinates']], dtype=float)
+            cum = get_cumulative_length(geo)
+            i = 0
             t_leg = 0.0
             for s in l['steps']:
-                step = Step(s['distance'], s['duration'], s['geometry']['coordinates'])
+                n = len(s['geometry']['coordinates'])
+                step = Step(s['distance'], s['duration'], geo[i:i+n], cum[i:i+n])
+                i += n
                 t_leg += s['duration']
                 leg.steps.append(step)
             assert np.isclose(t_leg, leg.t)
             # the last step of a leg is always of length 2, consisting of 2 identical points as a flag of the end of the leg
             assert len(step.geo) == 2
-            assert step.geo[0] == step.geo[1]
+            assert (step.geo[0] == step.geo[1]).all()
             # if pickup and the vehicle arrives in advance, add an extra wait
             if pod == 1:
                 if T+self.t+leg.t < reqs[rid].Cep:
@@ -187,127 +354,41 @@ class Veh(object):
             leg = Leg(rid, pod, tlng, tlat, d_, t_, steps=[])
             leg.steps.append(Step(d_, t_, [[self.tlng, self.tlat],[tlng, tlat]]))
             self.route.append(leg)
-        self.tlng = leg.steps[-1].geo[1][0]
-        self.tlat = leg.steps[-1].geo[1][1]
+        self.tlng = float(leg.steps[-1].geo[1][0])
+        self.tlat = float(leg.steps[-1].geo[1][1])
         self.d += leg.d
         self.t += leg.t
+        # the latest dropoff of an on-demand request follows its pickup time on the route
+        if pod == 1 and reqs is not None and reqs[rid].OnD:
+            reqs[rid].Cld = T + self.t + MAX_DETOUR * reqs[rid].Ts
         
-    # update the vehicle location as well as the route after moving to time T    
-    def move_to_time(self, T):
-        dT = T - self.T
-        if dT <= 0:
-            return []
-        # done is a list of finished legs
-        done = []
-        while dT > 0 and len(self.route) > 0:
-            leg = self.route[0]
-            # if the first leg could be finished by then
-            if leg.t < dT:
-                dT -= leg.t
-                self.T += leg.t
-                if self.T >= T_WARM_UP and self.T <= T_WARM_UP+T_STUDY:
-                    self.Ts += leg.t if leg.rid != -1 else 0
-                    self.Ds += leg.d if leg.rid != -1 else 0
-                    self.Tr += leg.t if leg.rid == -1 else 0
-                    self.Dr += leg.d if leg.rid == -1 else 0
-                    self.Lt += leg.t * self.n if leg.rid != -1 else 0
-                    self.Ld += leg.d * self.n if leg.rid != -1 else 0
-                self.jump_to_location(leg.tlng, leg.tlat)
-                self.n += leg.pod
-                done.append( (leg.rid, leg.pod, self.T) )
-                self.pop_leg()
-            else:
-                while dT > 0 and len(leg.steps) > 0:
-                    step = leg.steps[0]
-                    # if the first leg could not be finished, but the first step of the leg could be finished by then
-                    if step.t < dT:
-                        dT -= step.t
-                        self.T += step.t
-                        if self.T >= T_WARM_UP and self.T <= T_WARM_UP+T_STUDY:
-                            self.Ts += step.t if leg.rid != -1 else 0
-                            self.Ds += step.d if leg.rid != -1 else 0
-                            self.Tr += step.t if leg.rid == -1 else 0
-                            self.Dr += step.d if leg.rid == -1 else 0
-                            self.Lt += step.t * self.n if leg.rid != -1 else 0
-                            self.Ld += step.d * self.n if leg.rid != -1 else 0
-                        self.jump_to_location(leg.tlng, leg.tlat)
-                        self.pop_step()
-                        if len(leg.steps) == 0:
-                            # corner case: leg.t extremely small, but still larger than dT
-                            # this is due to the limited precision of the floating point numbers
-                            self.jump_to_location(leg.tlng, leg.tlat)
-                            self.n += leg.pod
-                            done.append( (leg.rid, leg.pod, self.T) )
-                            self.pop_leg()
-                            break
-                    # the vehicle has to stop somewhere within the step
-                    else:
-                        pct = dT / step.t
-                        if self.T >= T_WARM_UP and self.T <= T_WARM_UP+T_STUDY:
-                            self.Ts += dT if leg.rid != -1 else 0
-                            self.Ds += step.d * pct if leg.rid != -1 else 0
-                            self.Tr += dT if leg.rid == -1 else 0
-                            self.Dr += step.d * pct if leg.rid == -1 else 0
-                            self.Lt += dT * self.n if leg.rid != -1 else 0
-                            self.Ld += step.d * pct * self.n if leg.rid != -1 else 0
-                        # find the exact location the vehicle stops and update the step
-                        self.cut_step(pct)
-                        self.jump_to_location(step.geo[0][0], step.geo[0][1])
-                        self.T = T
-                        return done
-        assert dT > 0 or np.isclose(dT, 0.0)
-        assert self.T < T or np.isclose(self.T, T)
-        assert len(self.route) == 0 
-        assert self.n == 0
-        assert np.isclose(self.d, 0.0)
-        assert np.isclose(self.t, 0.0)
-        self.T = T
-        self.d = 0.0
-        self.t = 0.0
-        return done
-
-    # get the location at time T
-    # this function is similar to move_to_time(self, T), but it does not update the route
-    def get_location_at_time(self, T):
-        dT = T - self.T
-        if dT <= 0:
-            return self.lng, self.lat, self.n
-        lng = self.lng
-        lat = self.lat
-        n = self.n
-        route = copy.deepcopy(self.route)
-        while dT > 0 and len(route) > 0:
-            leg = route[0]
-            if leg.t < dT:
-                dT -= leg.t
-                lng = leg.tlng
-                lat = leg.tlat
+    # get the location at a fraction pct of the k-th step of the route, counting the steps of all legs
+    def get_location_on_route(self, k, pct):
+        for leg in self.route:
+            if k < len(leg.steps):
+                step = leg.steps[k]
+                if step.d == 0 or len(step.geo) < 2:
+                    return float(step.geo[0][0]), float(step.geo[0][1])
+                i, s, loc = step.locate(pct)
+                return float(loc[0]), float(loc[1])
+            k -= len(leg.steps)
+
+    # get the timeline of the route, built from its legs and steps when first needed
+    def get_timeline(self):
+        if self.tl is None:
+            rows = []
+            t = self.T
+            n = self.n
+            for leg in self.route:
+                for k, step in enumerate(leg.steps):
+                    t += step.t
+                    end = k == len(leg.steps) - 1
+                    rows.append( (t, step.t, step.d, leg.rid != -1, n, leg.rid if end else -1, leg.pod if end else 0, end,
+                                  leg.tlng, leg.tlat) )
                 n += leg.pod
-                route.popleft()
-            else:
-                while dT > 0 and len(leg.steps) > 0:
-                    step = leg.steps[0]
-                    if step.t < dT:
-                        dT -= step.t
-                        leg.steps.popleft()
-                        if len(leg.steps) == 0:
-                            # corner case: leg.t extremely small, but still larger than dT
-                            lng = leg.tlng
-                            lat = leg.tlat
-                            n += leg.pod
-                            route.popleft()
-                            break
-                    else:
-                        pct = dT / step.t
-                        self.cut_temp_step(step, pct)
-                        lng = step.geo[0][0]
-                        lat = step.geo[0][1]
-                        return lng, lat, n
-        assert dT > 0 or np.isclose(dT, 0.0)
-        assert len(route) == 0 
-        assert n == 0
-        return lng, lat, n
-    
+            self.tl = np.array(rows, dtype=float).reshape(-1, 10)
+        return self.tl
+
     # pop the first leg from the route list    
     def pop_leg(self):
         leg = self.route.popleft()
@@ -325,28 +406,8 @@ class Veh(object):
     # find the exact location the vehicle stops and update the step    
     def cut_step(self, pct):
         step = self.route[0].steps[0]
-        if step.d == 0:
-            _pct = pct
-        else:
-            dis = 0.0
-            sega = step.geo[0]
-            for segb in step.geo[1:]:
-                dis += np.sqrt( (sega[0] - segb[0])**2 + (sega[1] - segb[1])**2)
-                sega = segb
-            dis_ = 0.0
-            _dis = 0.0
-            sega = step.geo[0]
-            for segb in step.geo[1:]:
-                _dis = np.sqrt( (sega[0] - segb[0])**2 + (sega[1] - segb[1])**2)
-                dis_ += _dis
-                if dis_ / dis > pct:
-                    break
-                sega = segb
-            while step.geo[0] != sega:
-                step.geo.pop(0)
-            _pct = (pct * dis - dis_ + _dis) / _dis       
-            step.geo[0][0] = sega[0] + _pct * (segb[0] - sega[0])
-            step.geo[0][1] = sega[1] + _pct * (segb[1] - sega[1])     
+        if step.d != 0:
+            self.cut_geo(step, pct)
         self.t -= step.t * pct
         self.d -= step.d * pct
         self.route[0].t -= step.t * pct
@@ -354,29 +415,17 @@ class Veh(object):
         self.route[0].steps[0].t -= step.t * pct
         self.route[0].steps[0].d -= step.d * pct  
 
-    # similar to cut_step(self, pct), but always called by get_location_at_time(self, T)
-    def cut_temp_step(self, step, pct):
-        if step.d != 0:
-            dis = 0.0
-            sega = step.geo[0]
-            for segb in step.geo[1:]:
-                dis += np.sqrt( (sega[0] - segb[0])**2 + (sega[1] - segb[1])**2)
-                sega = segb
-            dis_ = 0.0
-            _dis = 0.0
-            sega = step.geo[0]
-            for segb in step.geo[1:]:
-                _dis = np.sqrt( (sega[0] - segb[0])**2 + (sega[1] - segb[1])**2)
-                dis_ += _dis
-                if dis_ / dis > pct:
-                    break
-                sega = segb
-            while step.geo[0] != sega:
-                step.geo.pop(0)
-            _pct = (pct * dis - dis_ + _dis) / _dis       
-            step.geo[0][0] = sega[0] + _pct * (segb[0] - sega[0])
-            step.geo[0][1] = sega[1] + _pct * (segb[1] - sega[1])     
-    
+    # cut the geometry of a step at a fraction pct of its length, so that it starts where the vehicle stops
+    def cut_geo(self, step, pct):
+        if len(step.cum) < 2 or step.cum[-1] == step.cum[0]:
+            return
+        k, s, loc = step.locate(pct)
+        # the points before the segment are dropped, and its start is moved to where the vehicle stops
+        step.geo = step.geo[k:]
+        step.cum = step.cum[k:]
+        step.geo[0] = loc
+        step.cum[0] = s
+
     # visualize
     def draw(self):
         color = "0.50"
@@ -433,14 +482,16 @@ class Req(object):
         Td: dropoff time
         D: detour factor
     """
-    def __init__(self, osrm, id, Tr, olng=0.115662, olat=51.374282, dlng=0.089282, dlat=51.350675, OnD=True):
+    __slots__ = ["id", "Tr", "olng", "olat", "dlng", "dlat", "Ts", "OnD", "Cep", "Clp", "Cld", "Tp", "Td", "D"]
+    def __init__(self, osrm, id, Tr, olng=0.115662, olat=51.374282, dlng=0.089282, dlat=51.350675, OnD=True, Ts=None):
         self.id = id
         self.Tr = Tr
         self.olng = olng
         self.olat = olat
         self.dlng = dlng
         self.dlat = dlat
-        self.Ts = osrm.get_duration(olng, olat, dlng, dlat)
+        # the shortest travel time is routed here unless already known
+        self.Ts = osrm.get_duration(olng, olat, dlng, dlat) if Ts is None else Ts
         self.OnD = OnD
         if self.OnD:
             self.Cep = Tr
@@ -476,6 +527,249 @@ class Req(object):
         return str
     
 
+class ReqStore(object):
+    """ 
+    ReqStore is a class for the requests of the system, stored as columns in chunks of a fixed number of requests
+    The ids of the requests are their positions in the store, so that a request is looked up by id in constant time
+    A request is also kept as an object of class Req until it is dropped off or rejected, as the dispatch works on objects,
+    and its columns are updated when it is finished; the objects of the finished requests are rebuilt from the columns
+    when looked up, and changes to them are not kept
+    Attributes:
+        N: number of requests
+        chunks: structured arrays of CHUNK requests each, with a field per attribute of class Req
+        live: the requests kept as objects, by id
+    """
+    CHUNK = 4096
+    DTYPE = np.dtype([("id", int), ("Tr", float), ("olng", float), ("olat", float), ("dlng", float), ("dlat", float),
+                      ("Ts", float), ("OnD", bool), ("Cep", float), ("Clp", float), ("Cld", float), 
+                      ("Tp", float), ("Td", float), ("D", float)])
+
+    def __init__(self):
+        self.N = 0
+        self.chunks = []
+        self.live = {}
+
+    def __len__(self):
+        return self.N
+
+    def __iter__(self):
+        for rid in range(self.N):
+            yield self[rid]
+
+    # get a request by id, or from the end if negative
+    def __getitem__(self, rid):
+        if rid < 0:
+            rid += self.N
+        req = self.live.get(rid)
+        if req is not None:
+            return req
+        if rid < 0 or rid >= self.N:
+            raise IndexError("request %d is not in the store" % rid)
+        row = self.chunks[rid // self.CHUNK][rid % self.CHUNK]
+        req = Req(None, int(row["id"]), float(row["Tr"]), float(row["olng"]), float(row["olat"]), 
+                  float(row["dlng"]), float(row["dlat"]), OnD=bool(row["OnD"]), Ts=float(row["Ts"]))
+        req.Cep = float(row["Cep"])
+        req.Clp = None if np.isnan(row["Clp"]) else float(row["Clp"])
+        req.Cld = None if np.isnan(row["Cld"]) else float(row["Cld"])
+        req.Tp = float(row["Tp"])
+        req.Td = float(row["Td"])
+        req.D = float(row["D"])
+        return req
+
+    # add a request, whose id is the number of requests so far
+    def append(self, req):
+        assert req.id == self.N
+        if self.N % self.CHUNK == 0:
+            self.chunks.append(np.zeros(self.CHUNK, dtype=self.DTYPE))
+        self.N += 1
+        self.live[req.id] = req
+        self.update(req)
+
+    # write the attributes of a request object into its columns
+    def update(self, req):
+        self.chunks[req.id // self.CHUNK][req.id % self.CHUNK] = (
+            req.id, req.Tr, req.olng, req.olat, req.dlng, req.dlat, req.Ts, req.OnD, req.Cep, 
+            np.nan if req.Clp is None else req.Clp, np.nan if req.Cld is None else req.Cld, req.Tp, req.Td, req.D)
+
+    # update the columns of a request that is dropped off or rejected, and drop its object
+    def finish(self, rid):
+        req = self.live.pop(rid, None)
+        if req is not None:
+            self.update(req)
+
+    # get the columns of the requests whose earliest pickups are within [t0, t1], as a structured array
+    def get_columns(self, t0=-np.inf, t1=np.inf):
+        for req in self.live.values():
+            self.update(req)
+        cols = [np.zeros(0, dtype=self.DTYPE)]
+        for k, chunk in enumerate(self.chunks):
+            chunk = chunk[:self.N - k*self.CHUNK]
+            cols.append(chunk[(chunk["Cep"] >= t0) & (chunk["Cep"] <= t1)])
+        return np.concatenate(cols)
+
+
+class Fleet(object):
+    """ 
+    Fleet is a class for the state of all vehicles as columns, to move them all at once
+    The route of each vehicle is kept as a timeline, an array with a row per step of its legs, with the columns
+    TEND (time the step ends), DUR (duration left), DIST (distance left), SVC (1 if in service, 0 if rebalancing),
+    LOAD (passengers on board), RID and POD (request id and pickup/dropoff of the leg, on its last step only), 
+    END (1 on the last step of a leg), and TLNG and TLAT (target of the leg)
+    The timelines of all vehicles are flattened into one array when they move, and the vehicles are updated after each move
+    Attributes:
+        V: number of vehicles
+        T: system time of each vehicle
+        lng: current longitude of each vehicle
+        lat: current latitude of each vehicle
+        n: number of passengers on board of each vehicle
+        Ds, Ts, Dr, Tr, Lt, Ld: accumulated distances, times and loads of each vehicle, as in class Veh
+    """
+    TEND, DUR, DIST, SVC, LOAD, RID, POD, END, TLNG, TLAT = range(10)
+
+    def __init__(self, vehs):
+        self.V = len(vehs)
+        self.T = np.array([veh.T for veh in vehs], dtype=float)
+        self.lng = np.array([veh.lng for veh in vehs], dtype=float)
+        self.lat = np.array([veh.lat for veh in vehs], dtype=float)
+        self.n = np.array([veh.n for veh in vehs], dtype=int)
+        self.Ds = np.array([veh.Ds for veh in vehs], dtype=float)
+        self.Ts = np.array([veh.Ts for veh in vehs], dtype=float)
+        self.Dr = np.array([veh.Dr for veh in vehs], dtype=float)
+        self.Tr = np.array([veh.Tr for veh in vehs], dtype=float)
+        self.Lt = np.array([veh.Lt for veh in vehs], dtype=float)
+        self.Ld = np.array([veh.Ld for veh in vehs], dtype=float)
+
+    # move all vehicles to time T, and update their locations, routes and statistics
+    # the finished steps are found at once by their end times, and the partial step of each vehicle is cut
+    # return the finished legs as arrays of vehicle ids, request ids, pickup/dropoff and times, in the order of the routes
+    def move_to_time(self, vehs, T):
+        TEND, DUR, DIST, SVC, LOAD, RID, POD, END, TLNG, TLAT = range(10)
+        X, vid, off, lens, start, done, ndone = self.get_steps(vehs, T)
+        # the finished steps are counted at the times they end, if within the study period
+        win = done & (X[:, TEND] >= T_WARM_UP) & (X[:, TEND] <= T_WARM_UP+T_STUDY)
+        svc = X[:, SVC]
+        self.Ts += np.bincount(vid, weights=X[:, DUR] * svc * win, minlength=self.V)
+        self.Ds += np.bincount(vid, weights=X[:, DIST] * svc * win, minlength=self.V)
+        self.Tr += np.bincount(vid, weights=X[:, DUR] * (1-svc) * win, minlength=self.V)
+        self.Dr += np.bincount(vid, weights=X[:, DIST] * (1-svc) * win, minlength=self.V)
+        self.Lt += np.bincount(vid, weights=X[:, DUR] * X[:, LOAD] * svc * win, minlength=self.V)
+        self.Ld += np.bincount(vid, weights=X[:, DIST] * X[:, LOAD] * svc * win, minlength=self.V)
+        self.n += np.bincount(vid, weights=X[:, POD] * done, minlength=self.V).round().astype(int)
+        # the vehicles that stop within a step, and the fraction of the step they travel
+        part = np.nonzero(ndone < lens)[0]
+        p = off[part] + ndone[part]
+        part = part[start[p] < T]
+        p = off[part] + ndone[part]
+        dt = T - start[p]
+        pct = np.where(X[p, DUR] > 0, dt / np.where(X[p, DUR] > 0, X[p, DUR], 1.0), 0.0)
+        # the partial steps are counted at the times they start, if within the study period
+        win = (start[p] >= T_WARM_UP) & (start[p] <= T_WARM_UP+T_STUDY)
+        svc = X[p, SVC]
+        self.Ts[part] += dt * svc * win
+        self.Ds[part] += X[p, DIST] * pct * svc * win
+        self.Tr[part] += dt * (1-svc) * win
+        self.Dr[part] += X[p, DIST] * pct * (1-svc) * win
+        self.Lt[part] += dt * X[p, LOAD] * svc * win
+        self.Ld[part] += X[p, DIST] * pct * X[p, LOAD] * svc * win
+        X[p, DUR] = X[p, TEND] - T
+        X[p, DIST] *= 1 - pct
+        # the legs and steps passed are removed from the routes of the vehicles, and the partial steps are cut
+        pcts = dict(zip(part.tolist(), pct.tolist()))
+        for v in np.nonzero(lens > 0)[0].tolist():
+            veh = vehs[v]
+            m = int(ndone[v])
+            while m > 0 and m >= len(veh.route[0].steps):
+                m -= len(veh.route[0].steps)
+                leg = veh.route[0]
+                veh.pop_leg()
+                self.lng[v] = leg.tlng
+                self.lat[v] = leg.tlat
+            for k in range(m):
+                veh.pop_step()
+                self.lng[v] = veh.route[0].tlng
+                self.lat[v] = veh.route[0].tlat
+            if v in pcts:
+                veh.cut_step(pcts[v])
+                self.lng[v], self.lat[v] = veh.route[0].steps[0].geo[0]
+            veh.sched = None
+            veh.tl = X[off[v]+ndone[v]:off[v+1]]
+            if len(veh.route) == 0:
+                veh.d = 0.0
+                veh.t = 0.0
+        self.T[:] = T
+        for v, veh in enumerate(vehs):
+            veh.T = T
+            veh.lng = float(self.lng[v])
+            veh.lat = float(self.lat[v])
+            veh.n = int(self.n[v])
+            veh.Ds = float(self.Ds[v])
+            veh.Ts = float(self.Ts[v])
+            veh.Dr = float(self.Dr[v])
+            veh.Tr = float(self.Tr[v])
+            veh.Lt = float(self.Lt[v])
+            veh.Ld = float(self.Ld[v])
+        e = np.nonzero(done & (X[:, END] == 1))[0]
+        return vid[e], X[e, RID].astype(int), X[e, POD].astype(int), X[e, TEND]
+
+    # get the locations and the numbers of passengers on board of all vehicles at time T, without moving them
+    # return arrays of longitudes, latitudes and numbers of passengers
+    def get_locations_at_time(self, vehs, T):
+        TEND, DUR, DIST, SVC, LOAD, RID, POD, END, TLNG, TLAT = range(10)
+        X, vid, off, lens, start, done, ndone = self.get_steps(vehs, T)
+        lng = self.lng.copy()
+        lat = self.lat.copy()
+        n = self.n + np.bincount(vid, weights=X[:, POD] * done, minlength=self.V).round().astype(int)
+        # the vehicles that finish their routes are at the targets of their last legs
+        fin = np.nonzero((lens > 0) & (ndone == lens))[0]
+        lng[fin] = X[off[fin+1]-1, TLNG]
+        lat[fin] = X[off[fin+1]-1, TLAT]
+        # the others that have moved are within a step
+        part = np.nonzero(ndone < lens)[0]
+        p = off[part] + ndone[part]
+        part = part[start[p] < T]
+        p = off[part] + ndone[part]
+        pct = (T - start[p]) / X[p, DUR]
+        for v, k, pct_ in zip(part.tolist(), ndone[part].tolist(), pct.tolist()):
+            lng[v], lat[v] = vehs[v].get_location_on_route(k, pct_)
+        return lng, lat, n
+
+    # flatten the timelines of the vehicles, and find the steps that are finished by time T
+    # return the steps, their vehicles, the offsets and numbers of the steps of each vehicle, the start times of the steps,
+    # whether they are finished, and the number of finished steps of each vehicle
+    def get_steps(self, vehs, T):
+        tls = [veh.get_timeline() for veh in vehs]
+        lens = np.array([len(tl) for tl in tls], dtype=int)
+        off = np.zeros(self.V+1, dtype=int)
+        off[1:] = np.cumsum(lens)
+        X = np.concatenate(tls) if off[-1] > 0 else np.zeros((0, 10))
+        vid = np.repeat(np.arange(self.V), lens)
+        # the start time of each step is the end time of the previous one, or the time of the vehicle
+        start = np.empty(len(X))
+        start[1:] = X[:-1, Fleet.TEND]
+        start[off[:-1][lens > 0]] = self.T[lens > 0]
+        # the steps are finished in order, so that the finished ones of each vehicle come first
+        done = (X[:, Fleet.TEND] < T) & (start < T)
+        ndone = np.bincount(vid[done], minlength=self.V)
+        return X, vid, off, lens, start, done, ndone
+
+
+class DurTable(dict):
+    """ 
+    DurTable is a duration table that gets the durations it does not have yet from the routing server
+    It maps (olng, olat, dlng, dlat) to duration, as the tables from Model.get_duration_table()
+    Attributes:
+        osrm: the routing engine
+    """
+    def __init__(self, osrm):
+        super().__init__()
+        self.osrm = osrm
+
+    def __missing__(self, key):
+        dt = self.osrm.get_duration(*key)
+        self[key] = dt if dt is not None else np.inf
+        return self[key]
+
+
 class Model(object):
     """
     Model is the class for the AMoD system
@@ -489,15 +783,28 @@ class Model(object):
         V: number of vehicles
         K: capacity of vehicles
         vehs: the list of vehicles
+        fleet: the state of the vehicles as columns, through which they move
         N: number of requests
-        reqs: the list of requests
+        reqs: the requests, in a columnar store looked up by id
         rejs: the list of rejected requests
         queue: requests in the queue
+        n_cand: number of candidate insertions tested in the current dispatch
+        n_pruned: number of candidate insertions pruned by lower bounds in the current dispatch
+        n_full: number of candidate insertions checked on the full route in the current dispatch
         assign: assignment method
         reopt: reoptimization method
         rebl: rebalancing method
+        n_worker: number of worker processes for the insertion heuristics and simulated annealing, 1 to run serially
+        pool: the pool of worker processes, started on first use
+        b_assign: wall-clock time budget of assignment at each interval (in seconds, None for no budget)
+        b_reopt: wall-clock time budget of reoptimization at each interval (in seconds, None for no budget)
+        b_rebl: wall-clock time budget of rebalancing at each interval (in seconds, None for no budget)
+        deadline: wall-clock time at which the current phase of the dispatch runs out of budget
+        hit: if true, the budget of the current phase has run out
+        n_hit: number of times the budget of each phase ran out
     """ 
-    def __init__(self, M, D, dqn=None, V=2, K=4, assign="ins", reopt="no", rebl="no"):
+    def __init__(self, M, D, dqn=None, V=2, K=4, assign="ins", reopt="no", rebl="no", n_worker=1,
+                 b_assign=None, b_reopt=None, b_rebl=None):
         # two random generators, the seed of which could be modified for debug use
         self.rs1 = np.random.RandomState(np.random.randint(0,1000000))
         self.rs2 = np.random.RandomState(np.random.randint(0,1000000))
@@ -510,16 +817,34 @@ class Model(object):
         self.vehs = []
         for i in range(V):
             self.vehs.append(Veh(i, self.rs2, K=K))
+        self.fleet = Fleet(self.vehs)
         self.N = 0
-        self.reqs = []
+        self.reqs = ReqStore()
         self.rejs = []
         self.queue = deque([])
+        self.n_cand = 0
+        self.n_pruned = 0
+        self.n_full = 0
         self.assign = assign
         self.reopt = reopt
         self.rebl = rebl
+        self.n_worker = n_worker
+        self.pool = None
+        self.b_assign = b_assign
+        self.b_reopt = b_reopt
+        self.b_rebl = b_rebl
+        self.deadline = np.inf
+        self.hit = False
+        self.n_hit = {"assign": 0, "reopt": 0, "rebl": 0}
+
+    # the pool of worker processes is left out of copies of the model
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
         
-    # generate one request, following exponential arrival interval   
-    def generate_request(self, osrm):
+    # draw the arrival interval, the OD pair and the type of the next request, following exponential arrival interval
+    def draw_request(self):
         dt = 3600.0/self.D * self.rs1.exponential()
         rand = self.rs1.rand()
         for m in self.M:
@@ -527,11 +852,15 @@ class Model(object):
                 OnD = True
                 if m[1] < 51.35:
                     OnD = False if self.rs1.rand() < PROB_ADV else True
-                req = Req(osrm, 
-                          0 if self.N == 0 else self.reqs[-1].id+1,
-                          dt if self.N == 0 else self.reqs[-1].Tr+dt,
-                          m[0], m[1], m[2], m[3], OnD=OnD)
-                break
+                return dt, m[0], m[1], m[2], m[3], OnD
+
+    # generate one request, following exponential arrival interval   
+    def generate_request(self, osrm):
+        dt, olng, olat, dlng, dlat, OnD = self.draw_request()
+        req = Req(osrm, 
+                  0 if self.N == 0 else self.reqs[-1].id+1,
+                  dt if self.N == 0 else self.reqs[-1].Tr+dt,
+                  olng, olat, dlng, dlat, OnD=OnD)
         return req
     
     # generate requests up to time T, following Poisson process  
@@ -540,8 +869,16 @@ class Model(object):
             req = self.generate_request(osrm)
             self.reqs.append(req)
             self.N += 1
-        while self.reqs[-1].Tr <= T:
-            req = self.generate_request(osrm)
+        # draw all requests up to time T first, so that their shortest travel times are routed concurrently
+        draws = []
+        Tr = self.reqs[-1].Tr
+        while Tr <= T:
+            dt, olng, olat, dlng, dlat, OnD = self.draw_request()
+            Tr += dt
+            draws.append( (Tr, olng, olat, dlng, dlat, OnD) )
+        Ts = osrm.get_durations([(olng, olat, dlng, dlat) for (Tr, olng, olat, dlng, dlat, OnD) in draws])
+        for (Tr, olng, olat, dlng, dlat, OnD), ts in zip(draws, Ts):
+            req = Req(osrm, self.reqs[-1].id+1, Tr, olng, olat, dlng, dlat, OnD=OnD, Ts=ts)
             self.queue.append(self.reqs[-1])
             self.reqs.append(req)
             self.N += 1
@@ -550,23 +887,34 @@ class Model(object):
     # dispatch the AMoD system: move vehicles, generate requests, assign, reoptimize and rebalance    
     def dispatch_at_time(self, osrm, T):
         self.T = T
-        for veh in self.vehs:
-            done = veh.move_to_time(T)
-            for (rid, pod, t) in done:
-                if pod == 1:
-                    self.reqs[rid].Tp = t
-                elif pod == -1:
-                    self.reqs[rid].Td = t
-                    self.reqs[rid].D = (self.reqs[rid].Td - self.reqs[rid].Tp)/self.reqs[rid].Ts
+        vids, rids, pods, ts = self.fleet.move_to_time(self.vehs, T)
+        for (rid, pod, t) in zip(rids.tolist(), pods.tolist(), ts.tolist()):
+            if pod == 1:
+                self.reqs[rid].Tp = t
+            elif pod == -1:
+                self.reqs[rid].Td = t
+                self.reqs[rid].D = (self.reqs[rid].Td - self.reqs[rid].Tp)/self.reqs[rid].Ts
+                self.reqs.finish(rid)
         self.generate_requests_to_time(osrm, T)
         print(self)
         if np.isclose(T % INT_ASSIGN, 0):
+            self.start_budget(self.b_assign)
             if self.assign == "ins":
                 self.insertion_heuristics(osrm, T)
+            elif self.assign == "bat":
+                self.batch_assignment(osrm, T)
+            elif self.assign == "rtv":
+                self.rtv_assignment(osrm, T)
+            self.end_budget("assign")
         if np.isclose(T % INT_REOPT, 0):
+            self.start_budget(self.b_reopt)
             if self.reopt == "hsa":
                 self.simulated_annealing(osrm)
+            elif self.reopt == "lns":
+                self.large_neighborhood_search(osrm)
+            self.end_budget("reopt")
         if np.isclose(T % INT_REBL, 0):
+            self.start_budget(self.b_rebl)
             if self.rebl == "sar":
                 self.rebalance_sar(osrm)
             elif self.rebl == "orp":
@@ -574,45 +922,314 @@ class Model(object):
             elif self.rebl == "dqn":
                 assert self.dqn != None
                 self.rebalance_dqn(osrm)    
+            self.end_budget("rebl")
+
+    # reject a request, which is then only kept in the columns of the store
+    def reject(self, req):
+        self.rejs.append(req)
+        self.reqs.finish(req.id)
+
+    # start a phase of the dispatch with a wall-clock budget (in seconds), or None for no budget
+    def start_budget(self, budget):
+        self.deadline = time.time() + budget if budget is not None else np.inf
+        self.hit = False
+
+    # check if the budget of the current phase has run out
+    # a phase stops when it has, and keeps the best solution found so far
+    def is_out_of_time(self):
+        if time.time() > self.deadline:
+            self.hit = True
+        return self.hit
+
+    # end a phase of the dispatch, and count it if its budget ran out
+    def end_budget(self, phase):
+        if self.hit:
+            self.n_hit[phase] += 1
+            print("    Budget of %s is hit (%d times so far)" % (phase, self.n_hit[phase]))
         
     # insertion heuristics    
     def insertion_heuristics(self, osrm, T):
-        l = len(self.queue)
-        for i in range(l):
+        self.n_cand = 0
+        self.n_pruned = 0
+        self.n_full = 0
+        if self.n_worker > 1 and len(self.queue) > 1:
+            self.insertion_heuristics_parallel(osrm, T)
+        else:
+            l = len(self.queue)
+            # the requests left when the budget runs out stay in the queue
+            for i in range(l):
+                if self.is_out_of_time():
+                    break
+                req = self.queue.popleft()
+                if not self.insert_heuristics(osrm, req, T):
+                    self.reject(req)
+        if self.n_cand > 0:
+            print("    Insertion Heuristics: %d of %d candidate insertions pruned by lower bounds, %d checked on the full route" % (self.n_pruned, self.n_cand, self.n_full))
+
+    # insertion heuristics with the vehicles sharded across worker processes
+    # each worker finds the best insertion of every queued request into each of its vehicles as they are now;
+    # the requests are then assigned in order as in insert_heuristics(), and the vehicles assigned a request
+    # earlier in the batch are evaluated again, so that the result is the same as the serial one
+    # once the budget runs out, the insertions already found are still committed: the vehicles assigned earlier in the
+    # batch are no longer evaluated again, so each request goes to the best of the other vehicles, or back to the queue
+    # if only those could have served it
+    def insertion_heuristics_parallel(self, osrm, T):
+        # the requests stay in the queue if the budget has run out before the workers start
+        if self.is_out_of_time():
+            return
+        reqs = list(self.queue)
+        self.queue.clear()
+        shards = [vids for vids in np.array_split(np.arange(len(self.vehs)), self.n_worker) if len(vids) > 0]
+        futures = [self.get_pool(osrm).submit(insert_shard, self.get_shard(vids, reqs), reqs, T) for vids in shards]
+        inss = [{} for req in reqs]
+        for future in futures:
+            ins_shard, n_cand, n_pruned, n_full = future.result()
+            for ins, ins_ in zip(inss, ins_shard):
+                ins.update(ins_)
+            self.n_cand += n_cand
+            self.n_pruned += n_pruned
+            self.n_full += n_full
+        assigned = []
+        for req, ins in zip(reqs, inss):
+            lost = [ins.pop(veh.id) for veh in assigned if veh.id in ins]
+            if not self.is_out_of_time():
+                ins.update(self.get_insertions(osrm, req, T, assigned))
+            vid_ = self.get_best_vehicle(ins)
+            if vid_ is not None:
+                veh_ = self.vehs[vid_]
+                veh_.build_route(osrm, ins[vid_][1], self.reqs, T)
+                if veh_ not in assigned:
+                    assigned.append(veh_)
+                print("    Insertion Heuristics: veh %d is assigned to req %d" % (veh_.id, req.id) )
+            elif self.hit and len(lost) > 0:
+                self.queue.append(req)
+            else:
+                print("    Insertion Heuristics: req %d is rejected!" % (req.id) )
+                self.reject(req)
+
+    # get the vehicle of the best of the insertions from get_insertions(), or None if there is none
+    # the vehicles are compared in the order of their ids with the same test as in insert_heuristics(), i.e. the cost
+    # of the new route against the cost of the vehicle plus the lowest additional cost so far, and the later vehicle
+    # wins on ties, so that the rounding of the additional costs picks the same vehicle as the serial insertion
+    def get_best_vehicle(self, ins):
+        dc_ = np.inf
+        vid_ = None
+        for vid in sorted(ins):
+            c = ins[vid][2]
+            if c <= self.vehs[vid].c + dc_:
+                dc_ = c - self.vehs[vid].c
+                vid_ = vid
+        return vid_
+
+    # get the pool of worker processes, each with its own copy of the routing engine
+    def get_pool(self, osrm):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.n_worker, initializer=init_worker, initargs=(pickle.dumps(osrm),))
+        return self.pool
+
+    # batch assignment: match the queued requests to the vehicles at once, with at most one request per vehicle,
+    # given the best insertion of each request into each vehicle in reach
+    # the requests left unmatched are then inserted one by one as in the insertion heuristics
+    def batch_assignment(self, osrm, T):
+        self.n_cand = 0
+        self.n_pruned = 0
+        self.n_full = 0
+        reqs = []
+        inss = []
+        # the requests left when the budget runs out stay in the queue
+        while len(self.queue) > 0 and not self.is_out_of_time():
+            req = self.queue.popleft()
+            reqs.append(req)
+            inss.append(self.get_insertions(osrm, req, T, self.get_vehicles_in_reach(osrm, req, T)))
+        # the feasible pairs of request and vehicle, with the additional costs
+        rows = np.array([k for k, ins in enumerate(inss) for vid in ins], dtype=int)
+        cols = np.array([vid for ins in inss for vid in ins], dtype=int)
+        costs = np.array([ins[vid][0] for ins in inss for vid in ins], dtype=float)
+        matched = set()
+        for k, vid in sorted(self.match(rows, cols, costs)):
+            req = reqs[k]
+            self.vehs[vid].build_route(osrm, inss[k][vid][1], self.reqs, T)
+            matched.add(req.id)
+            print("    Batch Assignment: veh %d is assigned to req %d" % (vid, req.id) )
+        print("    Batch Assignment: %d of %d requests matched, %d feasible pairs" % (len(matched), len(reqs), len(costs)))
+        left = [req for req in reqs if req.id not in matched]
+        for k, req in enumerate(left):
+            if self.is_out_of_time():
+                self.queue.extendleft(reversed(left[k:]))
+                break
+            if not self.insert_heuristics(osrm, req, T):
+                self.reject(req)
+
+    # request-trip-vehicle assignment: enumerate the trips, i.e. the groups of queued requests that a vehicle could serve
+    # together with its current route, and pick at most one trip per vehicle and per request with match_trips()
+    # a trip is tried only if its requests can pairwise share a ride and all its smaller trips are feasible for the vehicle
+    # the pairwise shareability and the trips of more than one request are computed within optional time budgets
+    # the requests left unassigned are then inserted one by one as in the insertion heuristics
+    def rtv_assignment(self, osrm, T):
+        self.n_cand = 0
+        self.n_pruned = 0
+        self.n_full = 0
+        reqs = []
+        # trips of one request, i.e. the best insertion of each request into each vehicle in reach
+        # trips maps (vehicle id, tuple of indices of requests) to (additional cost, route)
+        # the requests left when the budget of the assignment runs out stay in the queue
+        trips = {}
+        while len(self.queue) > 0 and not self.is_out_of_time():
             req = self.queue.popleft()
+            for vid, ins in self.get_insertions(osrm, req, T, self.get_vehicles_in_reach(osrm, req, T)).items():
+                trips[(vid, (len(reqs),))] = ins
+            reqs.append(req)
+        rr = self.get_shareable_pairs(osrm, reqs, T, self.get_deadline(RTV_RR_BUDGET))
+        # trips of more requests, built by inserting a request into a trip of one request less of the same vehicle
+        deadline = self.get_deadline(RTV_TRIP_BUDGET)
+        hit = False
+        size = 1
+        while size < self.K and not hit:
+            bases = [(vid, ks) for (vid, ks) in trips if len(ks) == size]
+            size += 1
+            for k in range(len(reqs)):
+                vehs = []
+                routes = []
+                tries = []
+                for (vid, ks) in bases:
+                    ks_ = tuple(sorted(ks + (k,)))
+                    if k <= ks[-1] or not all((k_, k) in rr for k_ in ks):
+                        continue
+                    if not all((vid, ks_[:m] + ks_[m+1:]) in trips for m in range(size)):
+                        continue
+                    vehs.append(self.vehs[vid])
+                    routes.append(list(trips[(vid, ks)][1]))
+                    tries.append(ks_)
+                if len(tries) == 0:
+                    continue
+                trip = {id(route): ks_ for route, ks_ in zip(routes, tries)}
+                for veh, route, cands, durs in self.get_candidates(osrm, reqs[k], T, vehs, routes):
+                    c_, route_ = self.get_best_insertion(osrm, veh, route, reqs[k], np.inf, cands, durs)
+                    if route_ is not None:
+                        trips[(veh.id, trip[id(route)])] = (c_ - veh.c, route_)
+                if time.time() > deadline:
+                    hit = True
+                    break
+        ks = set()
+        for (vid, ks_) in self.match_trips(trips, len(reqs)):
+            self.vehs[vid].build_route(osrm, trips[(vid, ks_)][1], self.reqs, T)
+            ks.update(ks_)
+            for k in ks_:
+                print("    RTV Assignment: veh %d is assigned to req %d" % (vid, reqs[k].id) )
+        print("    RTV Assignment: %d trips of up to %d requests, %d of %d requests assigned%s" % (
+            len(trips), size, len(ks), len(reqs), ", trip budget hit" if hit else ""))
+        left = [req for k, req in enumerate(reqs) if k not in ks]
+        for k, req in enumerate(left):
+            if self.is_out_of_time():
+                self.queue.extendleft(reversed(left[k:]))
+                break
             if not self.insert_heuristics(osrm, req, T):
-                self.rejs.append(req)
+                self.reject(req)
+
+    # get the deadline of a step of the current phase with its own budget (in seconds, None for no budget of its own)
+    def get_deadline(self, budget):
+        return min(time.time() + budget, self.deadline) if budget is not None else self.deadline
+
+    # match trips to vehicles given the trips as a dict of (vehicle id, tuple of indices of the n requests) to
+    # (additional cost, route), with at most one trip per vehicle and per request, assigning as many requests as possible
+    # at the lowest total cost by integer linear programming if SciPy is available, and otherwise greedily, larger trips
+    # first, then cheaper ones; return the list of trips
+    def match_trips(self, trips, n):
+        keys = sorted(trips)
+        if len(keys) == 0:
+            return []
+        try:
+            from scipy.optimize import milp, LinearConstraint, Bounds
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            vids = set()
+            ks = set()
+            pairs = []
+            for (vid, ks_) in sorted(keys, key=lambda trip: (-len(trip[1]), trips[trip][0], trip)):
+                if vid in vids or any(k in ks for k in ks_):
+                    continue
+                vids.add(vid)
+                ks.update(ks_)
+                pairs.append( (vid, ks_) )
+            return pairs
+        # trips of one request are a bipartite matching of requests to vehicles
+        if all(len(ks) == 1 for (vid, ks) in keys):
+            rows = np.array([ks[0] for (vid, ks) in keys], dtype=int)
+            cols = np.array([vid for (vid, ks) in keys], dtype=int)
+            costs = np.array([trips[key][0] for key in keys], dtype=float)
+            return [(int(vid), (int(k),)) for k, vid in self.match(rows, cols, costs)]
+        # a row per vehicle, then a row per request, each to be covered by at most one trip
+        vs = {vid: r for r, vid in enumerate(sorted(set(vid for (vid, ks) in keys)))}
+        rows = [vs[vid] for (vid, ks) in keys] + [len(vs) + k for (vid, ks) in keys for k in ks]
+        cols = list(range(len(keys))) + [t for t, (vid, ks) in enumerate(keys) for k in ks]
+        A = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(vs) + n, len(keys)))
+        sizes = np.array([len(ks) for (vid, ks) in keys], dtype=float)
+        costs = np.array([trips[key][0] for key in keys], dtype=float)
+        integrality = np.ones(len(keys))
+        bounds = Bounds(0, 1)
+        constraints = [LinearConstraint(A, 0, 1)]
+        # each request assigned is worth more than all the costs together, so the most requests are assigned first
+        big = np.abs(costs).sum() + 1.0
+        res = milp(costs - big*sizes, constraints=constraints, integrality=integrality, bounds=bounds, options={"mip_rel_gap": 0})
+        return [key for key, x in zip(keys, res.x) if x > 0.5]
+
+    # get the pairs (k1, k2) with k1 < k2 of requests that could share a ride, i.e. an empty vehicle at the origin
+    # of one of them could serve both; the pairs left untested when the deadline is reached are taken as not shareable
+    def get_shareable_pairs(self, osrm, reqs, T, deadline):
+        rr = set()
+        for k1 in range(len(reqs)):
+            for k2 in range(k1+1, len(reqs)):
+                for req, req_ in ((reqs[k1], reqs[k2]), (reqs[k2], reqs[k1])):
+                    veh = Veh(-1, None, K=self.K, T=T, lng=req.olng, lat=req.olat)
+                    route = [(req.id, 1, req.olng, req.olat), (req.id, -1, req.dlng, req.dlat)]
+                    if len(self.get_insertions(osrm, req_, T, [veh], [route])) > 0:
+                        rr.add( (k1, k2) )
+                        break
+            if time.time() > deadline:
+                print("    RTV Assignment: shareability budget hit after %d of %d requests" % (k1+1, len(reqs)))
+                break
+        return rr
+
+    # match rows to columns given the pairs (rows[k], cols[k]) allowed and their costs, each row and column at most once,
+    # with as many pairs as possible at the lowest total cost by the Hungarian method if SciPy is available,
+    # and otherwise greedily in increasing order of cost; return the list of matched pairs (row, col)
+    def match(self, rows, cols, costs):
+        if len(costs) == 0:
+            return []
+        rs, ri = np.unique(rows, return_inverse=True)
+        cs, ci = np.unique(cols, return_inverse=True)
+        try:
+            from scipy.optimize import linear_sum_assignment
+        except ImportError:
+            used_r = np.zeros(len(rs), dtype=bool)
+            used_c = np.zeros(len(cs), dtype=bool)
+            pairs = []
+            for k in np.argsort(costs, kind="stable"):
+                if not used_r[ri[k]] and not used_c[ci[k]]:
+                    used_r[ri[k]] = True
+                    used_c[ci[k]] = True
+                    pairs.append( (rows[k], cols[k]) )
+            return pairs
+        # a pair not allowed costs more than all the allowed ones together, so that the most pairs are matched
+        big = np.abs(costs).sum() + 1.0
+        mat = np.full((len(rs), len(cs)), big)
+        mat[ri, ci] = costs
+        r, c = linear_sum_assignment(mat)
+        ok = mat[r, c] < big
+        return list(zip(rs[r[ok]], cs[c[ok]]))
 
     # insert a request using the insertion heuristics method
+    # candidate insertions are first screened with lower bounds of the durations, and only the survivors are routed
     def insert_heuristics(self, osrm, req, T):
         dc_ = np.inf
         veh_ = None
         route_ = None
-        viol = None
-        for veh in self.vehs:
-            route = []
-            if not veh.idle:
-                for leg in veh.route:
-                    route.append( (leg.rid, leg.pod, leg.tlng, leg.tlat) )
-            else:
-                assert veh.c == 0
-            l = len(route)
-            c = veh.c
-            for i in range(l+1):
-                for j in range(i+1, l+2):
-                    route.insert(i, (req.id, 1, req.olng, req.olat) )
-                    route.insert(j, (req.id, -1, req.dlng, req.dlat) )
-                    flag, c_, viol = self.test_constraints_get_cost(osrm, route, veh, req, c+dc_)
-                    if flag:
-                        dc_ = c_ - c
-                        veh_ = veh
-                        route_ = copy.deepcopy(route)
-                    route.pop(j)
-                    route.pop(i)
-                    if viol > 0:
-                        break
-                if viol == 2:
-                    break
+        for veh, route, cands, durs in self.get_candidates(osrm, req, T, self.get_vehicles_in_reach(osrm, req, T)):
+            c_, route = self.get_best_insertion(osrm, veh, route, req, veh.c+dc_, cands, durs)
+            if route is not None:
+                dc_ = c_ - veh.c
+                veh_ = veh
+                route_ = route
         if veh_ != None:
             veh_.build_route(osrm, route_, self.reqs, T)
             print("    Insertion Heuristics: veh %d is assigned to req %d" % (veh_.id, req.id) )
@@ -621,14 +1238,197 @@ class Model(object):
             print("    Insertion Heuristics: req %d is rejected!" % (req.id) )
             return False
 
+    # get the best insertion of a request into each of the given vehicles, as a dict of vehicle id to
+    # (additional cost, route, cost of the route), leaving out the vehicles that cannot serve the request
+    # routes are the current routes of the vehicles unless given
+    def get_insertions(self, osrm, req, T, vehs, routes=None):
+        ins = {}
+        for veh, route, cands, durs in self.get_candidates(osrm, req, T, vehs, routes):
+            c_, route = self.get_best_insertion(osrm, veh, route, req, np.inf, cands, durs)
+            if route is not None:
+                ins[veh.id] = (c_ - veh.c, route, c_)
+        return ins
+
+    # get the vehicles that could serve a request
+    # an on-demand request can only be picked up in time by vehicles within reach of its origin
+    def get_vehicles_in_reach(self, osrm, req, T):
+        if req.OnD and IS_ROAD_ENABLED:
+            return self.get_vehicles_in_radius(osrm, req.olng, req.olat, MAX_SPEED * (req.Clp - T) + 2*SNAP_MARGIN)
+        elif req.OnD:
+            return self.get_vehicles_in_radius(osrm, req.olng, req.olat, osrm.cst_speed * (req.Clp - T))
+        else:
+            return self.vehs
+
+    # get the quadruples (veh, route, cands, durs) of the vehicles that have candidate insertions of a request left
+    # after the lower bounds, where route is the route of the vehicle as (rid, pod, tlng, tlat) and durs its duration table
+    # routes are the current routes of the vehicles unless given
+    def get_candidates(self, osrm, req, T, vehs, routes=None):
+        if routes is None:
+            routes = []
+            for veh in vehs:
+                route = []
+                if not veh.idle:
+                    for leg in veh.route:
+                        route.append( (leg.rid, leg.pod, leg.tlng, leg.tlat) )
+                else:
+                    assert veh.c == 0
+                routes.append(route)
+        cands = []
+        for veh, route in zip(vehs, routes):
+            cands.append(self.get_candidate_insertions(osrm, veh, route, req))
+        # without the road network, a duration costs less to compute than to look up in a table built for it,
+        # so all vehicles share a table that computes only the durations read
+        if not IS_ROAD_ENABLED:
+            durs = DurTable(osrm)
+            return [(veh, route, cands_, durs) for veh, route, cands_ in zip(vehs, routes, cands) if len(cands_) > 0]
+        # fetch the durations between all stops of each vehicle with candidates left, in one call per vehicle, all vehicles concurrently
+        vids = [vid for vid in range(len(vehs)) if len(cands[vid]) > 0]
+        # the tables that are fully cached are read first, and only the others are sent to the routing server
+        tables = osrm.gather(self.get_duration_table, [(osrm, vehs[vid], routes[vid], req) for vid in vids],
+                             cached=self.get_cached_duration_table)
+        return [(vehs[vid], routes[vid], cands[vid], durs) for vid, durs in zip(vids, tables)]
+
+    # get the cheapest of the candidate insertions of a request into a route that costs no more than C
+    # on ties, the later candidate wins; return (cost, route), or (None, None) if there is none
+    def get_best_insertion(self, osrm, veh, route, req, C, cands, durs):
+        c_ = None
+        route_ = None
+        skip = -1
+        # without a duration table, every candidate is checked on the full route, routing each leg
+        sched = veh.get_schedule(route, self.reqs, durs) if req.OnD and durs is not None else None
+        for (i, j) in cands:
+            # skip the rest of the positions of the dropoff, as in the full enumeration
+            if i == skip:
+                continue
+            # only the insertions that the schedule cannot rule out are checked on the full route
+            viol = -1 if sched is None else self.test_insertion(sched, veh, req, i, j, C, durs)
+            if viol == -1:
+                self.n_full += 1
+                route.insert(i, (req.id, 1, req.olng, req.olat) )
+                route.insert(j, (req.id, -1, req.dlng, req.dlat) )
+                flag, c, viol = self.test_constraints_get_cost(osrm, route, veh, req, C, durs)
+                if flag:
+                    c_ = c
+                    C = c
+                    route_ = list(route)
+                route.pop(j)
+                route.pop(i)
+            if viol == 2:
+                break
+            elif viol > 0:
+                skip = i
+        return c_, route_
+
+    # get a copy of the model with a shard of the vehicles, and only the state needed to insert a batch of requests,
+    # to be sent to a worker process
+    def get_shard(self, vids, reqs):
+        shard = copy.copy(self)
+        shard.dqn = None
+        shard.M = None
+        shard.rejs = []
+        shard.queue = deque([])
+        shard.vehs = [self.vehs[vid].get_stop_copy() for vid in vids]
+        shard.reqs = {req.id: req for req in reqs}
+        for veh in shard.vehs:
+            if not veh.idle:
+                for leg in veh.route:
+                    shard.reqs[leg.rid] = self.reqs[leg.rid]
+        return shard
+
+    # get the vehicles within a Euclidean distance r (in meters) of a location, in the order of their ids
+    # the reach of a pickup spans most of the map at any valid speed bound, so all vehicles are scanned at once
+    # rather than through a spatial index
+    def get_vehicles_in_radius(self, osrm, lng, lat, r):
+        vehs = self.vehs
+        if r < 0 or len(vehs) == 0:
+            return []
+        lngs = np.array([veh.lng for veh in vehs])
+        lats = np.array([veh.lat for veh in vehs])
+        ds = osrm.get_euclidean_distance(lngs, lats, lng, lat)
+        return [veh for veh, d in zip(vehs, ds) if d <= r]
+
+    # get the insertion positions (i, j) of the pickup and dropoff of a request into a route
+    # that are not proven infeasible by lower bounds of the durations
+    # without the road network, the lower bounds would be the durations themselves and only repeat the full check,
+    # so all positions are candidates
+    def get_candidate_insertions(self, osrm, veh, route, req):
+        l = len(route)
+        if not IS_ROAD_ENABLED:
+            return [(i, j) for i in range(l+1) for j in range(i+1, l+2)]
+        locs = [veh.get_location()]
+        locs.extend( (tlng, tlat) for (rid, pod, tlng, tlat) in route )
+        locs.append( req.get_origin() )
+        locs.append( req.get_destination() )
+        # a route runs between the positions its ends are snapped to, so the Euclidean distance less the snapping
+        # margin at both ends, at the maximum speed, bounds its duration from below
+        # as long as no location is farther than SNAP_MARGIN from the road and no road is faster than MAX_SPEED
+        mat = np.maximum(osrm.get_euclidean_matrix(locs, locs) - 2*SNAP_MARGIN, 0.0) / MAX_SPEED
+        lbs = {}
+        for (olng, olat), row in zip(locs, mat):
+            for (dlng, dlat), dt in zip(locs, row):
+                lbs[(olng, olat, dlng, dlat)] = dt
+        cands = []
+        for i in range(l+1):
+            for j in range(i+1, l+2):
+                route.insert(i, (req.id, 1, req.olng, req.olat) )
+                route.insert(j, (req.id, -1, req.dlng, req.dlat) )
+                viol = self.test_constraints_lower_bound(route, veh, req, lbs)
+                route.pop(j)
+                route.pop(i)
+                self.n_cand += 1
+                if viol == -1:
+                    cands.append( (i, j) )
+                else:
+                    self.n_pruned += 1
+                if viol > 0:
+                    break
+            if viol == 2:
+                break
+        return cands
+
     # simulated annealing
+    # the routes are lists of (rid, pod, tlng, tlat) that a move replaces rather than modifies, so that a rejected move
+    # leaves them as they were, and a move is evaluated by the change in the costs of its two vehicles only
+    # with more than one worker process, a chain runs in each of them at its own temperature, and all chains restart
+    # from the best solution found after each round
     def simulated_annealing(self, osrm):
         TEMP = 100
         STEPS = 100
         ROUNDS = 10
         success = False
-        base_cost = self.get_total_cost()
+        durs = DurTable(osrm)
+        routes, costs = self.get_routes_costs(osrm, durs)
+        routes_ = list(routes)
+        if self.n_worker > 1:
+            shard = self.get_shard(range(self.V), [])
+            temps = TEMP * np.geomspace(0.25, 4.0, self.n_worker)
+        for i in range(ROUNDS):
+            print("    Simulated Annealing: round %d, max iteration steps = %d" % (i, STEPS))
+            if self.n_worker > 1:
+                seeds = np.random.randint(0, 1000000, self.n_worker)
+                futures = [self.get_pool(osrm).submit(anneal_shard, shard, routes, costs, temp, STEPS, seed)
+                    for temp, seed in zip(temps, seeds)]
+                chains = [future.result() for future in futures]
+            else:
+                chains = [self.anneal(osrm, durs, routes, costs, TEMP, STEPS)]
+            # the chain that lowers the total cost the most wins, and the first one on ties
+            k = int(np.argmin([dc for (routes__, costs__, dc) in chains]))
+            if chains[k][2] < 0:
+                routes, costs = chains[k][0], chains[k][1]
+                success = True
+                print("    Simulated Annealing: a better solution is found!")
+            if self.is_out_of_time():
+                break
+        if success:
+            for veh, route, route_ in zip(self.vehs, routes, routes_):
+                if route != route_:
+                    veh.build_route(osrm, route, self.reqs, self.T)
+
+    # get the routes of all vehicles as lists of (rid, pod, tlng, tlat), with their costs given a duration table
+    # the cost of a route that is no longer feasible is None, and the vehicle is to be left as it is
+    def get_routes_costs(self, osrm, durs):
         routes = []
+        costs = []
         for veh in self.vehs:
             route = []
             if not veh.idle:
@@ -636,68 +1436,147 @@ class Model(object):
                     route.append( (leg.rid, leg.pod, leg.tlng, leg.tlat) )
             else:
                 assert veh.c == 0
-            routes.append([route, veh.c])
-        best_routes = copy.deepcopy(routes)
-        best_cost = base_cost
-        for i in range(ROUNDS):
-            print("    Simulated Annealing: round %d, max iteration steps = %d" % (i, STEPS))
-            for T in np.linspace(TEMP, 0, STEPS, endpoint=False):
-                v1, r1 = self.get_random_veh_req(routes)
-                v2, r2 = self.get_random_veh_req(routes)
-                # print(v1, r1, v2, r2)
-                if v1 == v2:
-                    continue
-                elif r1 == -1 and r2 == -1:
+            flag, c, viol = self.test_constraints_get_cost(osrm, route, veh, None, np.inf, durs)
+            routes.append(route)
+            costs.append(c if flag else None)
+        return routes, costs
+
+    # run a chain of simulated annealing from the given routes and costs, at temperatures decreasing from temp
+    # return the best routes and costs found, with the change of the total cost from the given ones
+    def anneal(self, osrm, durs, routes, costs, temp, steps):
+        best_routes = routes
+        best_costs = costs
+        routes = list(routes)
+        costs = list(costs)
+        cost = 0.0
+        best_cost = 0.0
+        for T in np.linspace(temp, 0, steps, endpoint=False):
+            if self.is_out_of_time():
+                break
+            v1, r1 = self.get_random_veh_req(routes)
+            v2, r2 = self.get_random_veh_req(routes)
+            if v1 == v2:
+                continue
+            elif r1 == -1 and r2 == -1:
+                continue
+            elif costs[v1] is None or costs[v2] is None:
+                continue
+            else:
+                route1, c1 = routes[v1], costs[v1]
+                route2, c2 = routes[v2], costs[v2]
+                if r1 != -1: 
+                    route1, c1 = self.remove_req_from_veh(osrm, route1, v1, r1, durs)
+                if r2 != -1: 
+                    route2, c2 = self.remove_req_from_veh(osrm, route2, v2, r2, durs)
+                if route1 is None or route2 is None:
                     continue
+                if r1 != -1:
+                    route2, c2 = self.insert_req_to_veh(osrm, route2, v2, r1, durs)
+                    if route2 is None:
+                        continue
+                if r2 != -1:
+                    route1, c1 = self.insert_req_to_veh(osrm, route1, v1, r2, durs)
+                    if route1 is None:
+                        continue
+                dc = c1 + c2 - costs[v1] - costs[v2]
+                if dc < 0 or np.random.rand() < math.exp(-dc/T):
+                    routes[v1], costs[v1] = route1, c1
+                    routes[v2], costs[v2] = route2, c2
+                    cost += dc
+                    if cost < best_cost:
+                        best_routes = list(routes)
+                        best_costs = list(costs)
+                        best_cost = cost
+        return best_routes, best_costs, best_cost
+
+    # large neighborhood search: remove a cluster of related requests from their vehicles, reinsert them one by one
+    # at their cheapest positions in the vehicles in reach, and keep the result if it lowers the total cost
+    # the requests related to a random one are those not picked up yet by the vehicles in its reach, the closest first
+    # only the costs of the vehicles changed by a move are evaluated
+    # each iteration searches insertions for all requests of the cluster, so this costs far more than
+    # simulated annealing; it stops early when the reoptimization budget runs out
+    def large_neighborhood_search(self, osrm):
+        ITERS = 5
+        N_REMOVE = 4
+        eps = 1e-6
+        durs = DurTable(osrm)
+        routes, costs = self.get_routes_costs(osrm, durs)
+        routes_ = list(routes)
+        # the vehicle of each request that could be moved
+        vids = {}
+        for v, route in enumerate(routes):
+            if costs[v] is not None:
+                for (rid, pod, tlng, tlat) in route:
+                    if pod == 1:
+                        vids[rid] = v
+        if len(vids) == 0:
+            return
+        rids = list(vids)
+        n_iter = 0
+        n_better = 0
+        while n_iter < ITERS and not self.is_out_of_time():
+            n_iter += 1
+            req = self.reqs[rids[np.random.randint(len(rids))]]
+            vehs = [veh for veh in self.get_vehicles_in_reach(osrm, req, self.T) if costs[veh.id] is not None]
+            related = [rid for veh in vehs for (rid, pod, tlng, tlat) in routes[veh.id] if pod == 1 and rid != req.id]
+            if len(related) > 0:
+                dist = osrm.get_euclidean_matrix([req.get_origin()], [self.reqs[rid].get_origin() for rid in related])[0] \
+                    + osrm.get_euclidean_matrix([req.get_destination()], [self.reqs[rid].get_destination() for rid in related])[0]
+                related = [related[k] for k in np.argsort(dist, kind="stable")[:N_REMOVE-1]]
+            cluster = [req.id] + related
+            # the routes and costs of the vehicles changed by the move
+            trial = {}
+            moved = {}
+            for rid in cluster:
+                v = vids[rid]
+                route, c = trial.get(v, (routes[v], costs[v]))
+                route, c = self.remove_req_from_veh(osrm, route, v, rid, durs)
+                if route is None:
+                    break
+                trial[v] = (route, c)
+            else:
+                # the most urgent requests are reinserted first, by their latest pickup (which for an in-advance
+                # request is the latest one that still makes its dropoff in time)
+                for rid in sorted(cluster, key=lambda rid: self.get_latest_pickup(self.reqs[rid])):
+                    req_ = self.reqs[rid]
+                    vehs_ = [veh for veh in self.get_vehicles_in_reach(osrm, req_, self.T) if costs[veh.id] is not None]
+                    rs = [trial[veh.id][0] if veh.id in trial else routes[veh.id] for veh in vehs_]
+                    best = None
+                    for veh, route, cands, durs_ in self.get_candidates(osrm, req_, self.T, vehs_, rs):
+                        # the durations already known are kept, so that all costs are evaluated on the same durations
+                        if durs_ is not None:
+                            for key in durs_:
+                                durs.setdefault(key, durs_[key])
+                        c_, route_ = self.get_best_insertion(osrm, veh, route, req_, np.inf, cands, durs)
+                        if route_ is not None:
+                            dc = c_ - (trial[veh.id][1] if veh.id in trial else costs[veh.id])
+                            if best is None or dc < best[0]:
+                                best = (dc, veh.id, route_, c_)
+                    if best is None:
+                        break
+                    trial[best[1]] = (best[2], best[3])
+                    moved[rid] = best[1]
                 else:
-                    rc1 = copy.deepcopy(routes[v1])
-                    rc2 = copy.deepcopy(routes[v2])
-                    # print(rc1, rc2)
-                    if r1 != -1: 
-                        self.remove_req_from_veh(osrm, rc1, v1, r1)
-                    if r2 != -1: 
-                        self.remove_req_from_veh(osrm, rc2, v2, r2)
-                    if r1 != -1:
-                        if not self.insert_req_to_veh(osrm, rc2, v2, r1):
-                            continue
-                    if r2 != -1:
-                        if not self.insert_req_to_veh(osrm, rc1, v1, r2):
-                            continue
-                    # print(rc1, rc2)
-                    dc = rc1[1] + rc2[1] - routes[v1][1] - routes[v2][1]
-                    if dc < 0 or np.random.rand() < math.exp(-dc/T):
-                        # if r1 != -1 and r2 != -1:
-                        #     print("    SA: swap req %d (veh %d) and req %d (veh %d), dc = %.1f, p = %.3f" % (
-                        #         r1, v1, r2, v2, dc, 1.0 if dc<0 else math.exp(-dc/T)))
-                        # elif r1 != -1:
-                        #     print("    SA: insert req %d (veh %d) to veh %d, dc = %.1f, p = %.3f" % (
-                        #         r1, v1, v2, dc, 1.0 if dc<0 else math.exp(-dc/T)))
-                        # elif r2 != -1:
-                        #     print("    SA: insert req %d (veh %d) to veh %d, dc = %.1f, p = %.3f" % (
-                        #         r2, v2, v1, dc, 1.0 if dc<0 else math.exp(-dc/T)))
-                        routes[v1] = copy.deepcopy(rc1)
-                        routes[v2] = copy.deepcopy(rc2)
-                        cost = self.get_routes_cost(routes)
-                        # print("    SA: round %d, temperature = %.1f, base cost = %.1f, cost = %.1f" % (
-                        #     i, T, base_cost, cost))
-                        if cost < best_cost:
-                            best_routes = copy.deepcopy(routes)
-                            best_cost = cost
-                            success = True
-                            print("    Simulated Annealing: a better solution is found!")
-            routes = copy.deepcopy(best_routes)
-            base_cost = best_cost
-        if success:
-            for veh, route in zip(self.vehs, best_routes):
-                veh.build_route(osrm, route[0])
-                if not np.isclose(veh.c, route[1]):
-                    pass
+                    dc = sum(c - costs[v] for v, (route, c) in trial.items())
+                    if dc < -eps:
+                        for v, (route, c) in trial.items():
+                            routes[v], costs[v] = route, c
+                        vids.update(moved)
+                        n_better += 1
+        print("    Large Neighborhood Search: %d iterations, %d better solutions found" % (n_iter, n_better))
+        for veh, route, route_ in zip(self.vehs, routes, routes_):
+            if route != route_:
+                veh.build_route(osrm, route, self.reqs, self.T)
+
+    # get the latest time a request can be picked up
+    def get_latest_pickup(self, req):
+        return req.Clp if req.OnD else req.Cld - req.Ts
 
     # get a random request from a random vehicle
     def get_random_veh_req(self, routes):
         v = np.random.randint(self.V)
         n = 0
-        for leg in routes[v][0]:
+        for leg in routes[v]:
             if leg[1] == 1:
                 n += 1
         if n == 0:
@@ -706,70 +1585,32 @@ class Model(object):
         if r == n:
             return v, -1
         n_ = -1
-        for leg in routes[v][0]:
+        for leg in routes[v]:
             if leg[1] == 1:
                 n_ += 1
                 if n_ == r:
                     return v, leg[0]
 
-    # remove the request from the vehicle
-    def remove_req_from_veh(self, osrm, rc, v, r):
-        route_ = rc[0]
-        p = -1
-        d = -1
-        for leg, i in zip(route_, range(len(route_))):
-            if leg[0] == r and leg[1] == 1:
-                p = i
-            elif leg[0] == r and leg[1] == -1:
-                d = i
-        assert p != -1 and d != -1 and p < d
-        route_.pop(p)
-        route_.pop(d-1)
-        c = 0.0
-        t = 0.0
-        veh = self.vehs[v]
-        lng = veh.lng
-        lat = veh.lat
-        n = veh.n
-        for (rid, pod, tlng, tlat) in route_:
-            dt = osrm.get_duration(lng, lat, tlng, tlat)
-            t += dt
-            c += n * dt * COEF_INVEH
-            n += pod
-            assert n <= veh.K
-            c += t * COEF_WAIT if pod == 1 else 0
-            lng = tlng
-            lat = tlat
-        rc[1] = c
+    # remove a request from the route of a vehicle
+    # return the new route and its cost, or (None, None) if it is infeasible
+    def remove_req_from_veh(self, osrm, route, v, r, durs):
+        route_ = [leg for leg in route if leg[0] != r]
+        assert len(route_) == len(route) - 2
+        flag, c, viol = self.test_constraints_get_cost(osrm, route_, self.vehs[v], None, np.inf, durs)
+        if flag:
+            return route_, c
+        else:
+            return None, None
 
-    # insert a request to the vehicle
-    def insert_req_to_veh(self, osrm, rc, v, r):
+    # insert a request into the route of a vehicle at the best positions
+    # return the new route and its cost, or (None, None) if it is infeasible
+    def insert_req_to_veh(self, osrm, route, v, r, durs):
         veh = self.vehs[v]
         req = self.reqs[r]
-        c_ = np.inf
-        viol = None
-        route = copy.deepcopy(rc[0])
-        l = len(route)
-        for i in range(l+1):
-            for j in range(i+1, l+2):
-                route.insert(i, (req.id, 1, req.olng, req.olat) )
-                route.insert(j, (req.id, -1, req.dlng, req.dlat) )
-                flag, c, viol = self.test_constraints_get_cost(osrm, route, veh, req, c_)
-                if flag:
-                    c_ = c
-                    route_ = copy.deepcopy(route)
-                route.pop(j)
-                route.pop(i)
-                if viol in [1,2,3]:
-                    break
-            if viol == 2:
-                break
-        if c_ != np.inf:
-            rc[0] = route_
-            rc[1] = c_
-            return True
-        else:
-            return False
+        route = list(route)
+        cands = self.get_candidate_insertions(osrm, veh, route, req)
+        c_, route_ = self.get_best_insertion(osrm, veh, route, req, np.inf, cands, durs)
+        return route_, c_
 
     # get the total cost of all vehicles
     def get_total_cost(self):
@@ -778,15 +1619,105 @@ class Model(object):
             c += veh.c
         return c
 
-    # get the total cost from input routes
-    def get_routes_cost(self, routes):
-        c = 0.0
-        for rc in routes:
-            c += rc[1]
-        return c
-    
+    # get the durations between all pairs of locations among the vehicle, its route and the new request
+    # returns a dictionary mapping (olng, olat, dlng, dlat) to duration, or None if the routing server fails
+    # (or, if cached_only, if some durations are not cached)
+    def get_duration_table(self, osrm, veh, route, req, cached_only=False):
+        locs = [veh.get_location()]
+        locs.extend( (tlng, tlat) for (rid, pod, tlng, tlat) in route )
+        locs.append( req.get_origin() )
+        locs.append( req.get_destination() )
+        mat = osrm.get_duration_matrix(locs, locs, cached_only)
+        if mat is None:
+            return None
+        durs = {}
+        for (olng, olat), row in zip(locs, mat):
+            for (dlng, dlat), dt in zip(locs, row):
+                durs[(olng, olat, dlng, dlat)] = dt
+        return durs
+
+    # get the duration table of get_duration_table() if it is known without calling the routing server, or None
+    def get_cached_duration_table(self, osrm, veh, route, req):
+        return self.get_duration_table(osrm, veh, route, req, cached_only=True)
+
+    # test the insertion of the pickup and dropoff of an on-demand request at positions i and j of a route in constant time
+    # using the schedule of the route: stops after the pickup are delayed by the same amount until the dropoff,
+    # and by another amount after it, which are compared to the slack of the stops
+    # returns the violation code of test_constraints_get_cost() if the insertion is infeasible or costs more than C,
+    # or -1 if it has to be checked on the full route (as do borderline cases, within the rounding errors)
+    def test_insertion(self, sched, veh, req, i, j, C, durs):
+        eps = 1e-6
+        l = len(sched.t) - 1
+        T = veh.T
+        # the pickup is inserted after stop i, and the dropoff after stop j-1 of the route
+        j -= 1
+        if sched.K > veh.K or sched.nin[i][j] + 1 > veh.K:
+            return 1 # over capacity
+        # the stops before the pickup are unchanged
+        if sched.bad <= i or sched.c[i] > C:
+            return 0
+        o = req.get_origin()
+        d = req.get_destination()
+        tp = sched.t[i] + durs[sched.locs[i] + o]
+        if T + tp > req.Clp:
+            return 2 # late pickup
+        if j > i:
+            dt1 = tp + durs[o + sched.locs[i+1]] - sched.t[i+1]
+            if dt1 > sched.ain[i][j] + eps or dt1 > sched.rin[i][j] + eps:
+                return 0
+            td = sched.t[j] + dt1 + durs[sched.locs[j] + d]
+        else:
+            dt1 = 0.0
+            td = tp + durs[o + d]
+        if td - tp > MAX_DETOUR * req.Ts - eps:
+            return -1 # possibly late dropoff, which is told apart from other violations on the full route
+        if j < l:
+            dt2 = td + durs[d + sched.locs[j+1]] - sched.t[j+1]
+            if dt2 > sched.amin[j+1] + eps or dt2 > sched.rout[i][j] + eps:
+                return 0
+        else:
+            dt2 = 0.0
+        c = sched.c[l] + dt1 * (sched.sw[i+1] - sched.sw[j+1]) + dt2 * sched.sw[j+1] + tp * (COEF_WAIT - COEF_INVEH) + td * COEF_INVEH
+        if c > C + eps * max(1.0, abs(C)):
+            return 0
+        return -1
+
+    # test if a route could satisfy its deadlines given a table of lower bounds of the durations, without routing
+    # only deadlines that longer durations cannot help to meet are tested: the latest pickups, and the latest dropoffs
+    # of requests not picked up along the route (as the others move with the pickup time)
+    # returns the violation code of test_constraints_get_cost(), or -1 if the route may be feasible
+    def test_constraints_lower_bound(self, route, veh, req, lbs):
+        t = 0.0
+        n = veh.n
+        T = veh.T
+        lng = veh.lng
+        lat = veh.lat
+        for (rid, pod, tlng, tlat) in route:
+            n += pod
+            if n > veh.K:
+                return 1 # over capacity
+        picked = set()
+        for (rid, pod, tlng, tlat) in route:
+            req_ = self.reqs[rid]
+            t += lbs[(lng, lat, tlng, tlat)]
+            if pod == 1:
+                picked.add(rid)
+                if req_.OnD:
+                    if T + t > req_.Clp:
+                        return 2 if rid == req.id else 0 # late pickup
+                elif T + t < req_.Cep:
+                    t = req_.Cep - T
+            elif pod == -1 and (not req_.OnD or rid not in picked) and T + t > req_.Cld:
+                return 3 if rid == req.id else 0 # late dropoff
+            lng = tlng
+            lat = tlat
+        return -1
+
     # test if a route can satisfy all constraints, and if yes, return the cost of the route
-    def test_constraints_get_cost(self, osrm, route, veh, req, C):
+    # req is the request being inserted, if any, whose violations are told apart from the others
+    # durs is an optional duration table from get_duration_table(), used instead of routing each leg
+    def test_constraints_get_cost(self, osrm, route, veh, req, C, durs=None):
+        rid_ = req.id if req is not None else None
         c = 0.0
         t = 0.0
         n = veh.n
@@ -799,22 +1730,27 @@ class Model(object):
             if n > K:
                 return False, None, 1 # over capacity
         n = veh.n
+        # latest dropoffs of the on-demand requests picked up on the route, which follow their pickup times
+        Clds = {}
         for (rid, pod, tlng, tlat) in route:
             req_ = self.reqs[rid]
-            dt = osrm.get_duration(lng, lat, tlng, tlat)
+            if durs is not None:
+                dt = durs[(lng, lat, tlng, tlat)]
+            else:
+                dt = osrm.get_duration(lng, lat, tlng, tlat)
             t += dt
             if pod == 1:
                 if req_.OnD:
                     if T + t > req_.Clp:
-                        return False, None, 2 if rid == req.id else 0 # late pickup
+                        return False, None, 2 if rid == rid_ else 0 # late pickup
                     else:
-                        req_.Cld = T + t + MAX_DETOUR * req_.Ts
+                        Clds[rid] = T + t + MAX_DETOUR * req_.Ts
                 else:
                     if T + t < req_.Cep:
                         dt += req_.Cep - T - t
                         t += req_.Cep - T - t
-            elif pod == -1 and T + t > req_.Cld:
-                return False, None, 3 if rid == req.id else 0 # late dropoff
+            elif pod == -1 and T + t > Clds.get(rid, req_.Cld):
+                return False, None, 3 if rid == rid_ else 0 # late dropoff
             c += n * dt * COEF_INVEH
             n += pod
             assert n <= veh.K
@@ -828,6 +1764,8 @@ class Model(object):
     # rebalance using simple anticipatory rebalancing
     def rebalance_sar(self, osrm):
         for veh in self.vehs:
+            if self.is_out_of_time():
+                break
             if veh.idle:
                 veh.clear_route()
                 veh.rebl = False
@@ -848,43 +1786,31 @@ class Model(object):
         v = np.zeros((Nlat, Nlng))
         s = np.zeros((Nlat, Nlng))
         b = np.zeros((Nlat, Nlng))
-        for m in self.M:
-            for i,j in itertools.product(range(Nlat), range(Nlng)):
-                if m[1] >= Dlat - (i+1)*Elat:
-                    if m[0] <= Olng + (j+1)*Elng:
-                        d[i][j] += m[4] * self.D
-                        c[i][j][0] += m[0] * m[4] * self.D
-                        c[i][j][1] += m[1] * m[4] * self.D
-                        break
-        for i,j in itertools.product(range(Nlat), range(Nlng)):
-            if d[i][j] != 0:
-                c[i][j][0] /= d[i][j]
-                c[i][j][1] /= d[i][j]
+        M = np.array(self.M, dtype=float).reshape(-1, 6)
+        i, j = self.get_cells(M[:, 0], M[:, 1])
+        in_map = i >= 0
+        np.add.at(d, (i[in_map], j[in_map]), (M[:, 4] * self.D)[in_map])
+        np.add.at(c[:, :, 0], (i[in_map], j[in_map]), (M[:, 0] * M[:, 4] * self.D)[in_map])
+        np.add.at(c[:, :, 1], (i[in_map], j[in_map]), (M[:, 1] * M[:, 4] * self.D)[in_map])
+        c[d != 0] /= d[d != 0][:, np.newaxis]
+        idle = []
+        busy = []
+        lngs, lats, ns = self.fleet.get_locations_at_time(self.vehs, T+INT_REBL)
         for veh in self.vehs:
             if veh.idle:
                 veh.clear_route()
                 veh.rebl = False
-                for i,j in itertools.product(range(Nlat), range(Nlng)):
-                    if veh.lat >= Dlat - (i+1)*Elat:
-                        if veh.lng <= Olng + (j+1)*Elng:
-                            v[i][j] += 1
-                            break
+                idle.append( (veh.lng, veh.lat) )
             else:
-                lng, lat, n = veh.get_location_at_time(T+INT_REBL)
-                for i,j in itertools.product(range(Nlat), range(Nlng)):
-                    if lat >= Dlat - (i+1)*Elat:
-                        if lng <= Olng + (j+1)*Elng:
-                            if n == 0:
-                                s[i][j] += 0.8
-                            elif n == 1:
-                                s[i][j] += 0.4
-                            elif n == 2:
-                                s[i][j] += 0.2
-                            elif n == 3:
-                                s[i][j] += 0.1 
-                            else:
-                                s[i][j] += 0.0
-                            break
+                busy.append( (lngs[veh.id], lats[veh.id], ns[veh.id]) )
+        idle = np.array(idle, dtype=float).reshape(-1, 2)
+        busy = np.array(busy, dtype=float).reshape(-1, 3)
+        i, j = self.get_cells(idle[:, 0], idle[:, 1])
+        np.add.at(v, (i[i >= 0], j[i >= 0]), 1)
+        # vehicles in service are expected to be available with a probability decreasing with their occupancy
+        i, j = self.get_cells(busy[:, 0], busy[:, 1])
+        avail = np.array([0.8, 0.4, 0.2, 0.1, 0.0])[np.minimum(busy[:, 2].astype(int), 4)]
+        np.add.at(s, (i[i >= 0], j[i >= 0]), avail[i >= 0])
         for i,j in itertools.product(range(Nlat), range(Nlng)):
             if d[i][j] == 0:
                 continue
@@ -896,22 +1822,19 @@ class Model(object):
                 k += 1
             b[i][j] = 1 - p
         while np.sum(v) > 0:
+            # the idle vehicles left when the budget runs out stay where they are
+            if self.is_out_of_time():
+                return
             i, j = np.unravel_index(b.argmax(), b.shape)
-            dis = np.inf
-            vid = None
-            for vid_, veh in enumerate(self.vehs):
-                if veh.idle and not veh.rebl:
-                    dis_ = osrm.get_distance(veh.lng, veh.lat, c[i][j][0], c[i][j][1])
-                    if dis_ < dis:
-                        dis = dis_
-                        vid = vid_
+            vids = [vid_ for vid_, veh in enumerate(self.vehs) if veh.idle and not veh.rebl]
+            diss = osrm.get_distances([(self.vehs[vid_].lng, self.vehs[vid_].lat, c[i][j][0], c[i][j][1]) for vid_ in vids])
+            diss = np.array([np.inf if dis_ is None else dis_ for dis_ in diss], dtype=float)
+            vid = vids[np.argmin(diss)]
             route = [(-1, 0, c[i][j][0], c[i][j][1])]
             self.vehs[vid].build_route(osrm, route)
-            for i_, j_ in itertools.product(range(Nlat), range(Nlng)):
-                if self.vehs[vid].lat >= Dlat - (i_+1)*Elat:
-                    if self.vehs[vid].lng <= Olng + (j_+1)*Elng:
-                        v[i_][j_] -= 1
-                        break
+            i_, j_ = self.get_cells([self.vehs[vid].lng], [self.vehs[vid].lat])
+            if i_[0] >= 0:
+                v[i_[0]][j_[0]] -= 1
             s[i][j] += 1
             if d[i][j] == 0:
                 continue
@@ -925,6 +1848,28 @@ class Model(object):
         assert np.sum(v) == 0
         assert np.min(v) == 0
 
+    # get the cells (i, j) of the gridded map that arrays of locations fall in, with i = j = -1 if out of the map
+    # a location on the border of two cells is counted in the first one, in row-major order
+    def get_cells(self, lngs, lats):
+        lngs = np.asarray(lngs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        in_i = lats[:, np.newaxis] >= Dlat - (np.arange(Nlat)+1)*Elat
+        in_j = lngs[:, np.newaxis] <= Olng + (np.arange(Nlng)+1)*Elng
+        in_map = in_i.any(axis=1) & in_j.any(axis=1)
+        return np.where(in_map, in_i.argmax(axis=1), -1), np.where(in_map, in_j.argmax(axis=1), -1)
+
+    # get the cells (i, j) of the moving grid centered at (lng, lat) that arrays of locations fall in
+    # with i = j = -1 if out of the grid
+    def get_moving_cells(self, lng, lat, lngs, lats):
+        lngs = np.asarray(lngs, dtype=float)[:, np.newaxis]
+        lats = np.asarray(lats, dtype=float)[:, np.newaxis]
+        i = np.arange(Mlat)
+        j = np.arange(Mlng)
+        in_i = (lats <= lat + Mlat*Elat/2 - i*Elat) & (lats >= lat + Mlat*Elat/2 - (i+1)*Elat)
+        in_j = (lngs >= lng - Mlng*Elng/2 + j*Elng) & (lngs <= lng - Mlng*Elng/2 + (j+1)*Elng)
+        in_grid = in_i.any(axis=1) & in_j.any(axis=1)
+        return np.where(in_grid, in_i.argmax(axis=1), -1), np.where(in_grid, in_j.argmax(axis=1), -1)
+
     # rebalance using deep Q network
     def rebalance_dqn(self, osrm):
         Mlng = 5
@@ -932,6 +1877,8 @@ class Model(object):
         Elng = 0.02
         Elat = 0.015
         for veh in self.vehs:
+            if self.is_out_of_time():
+                break
             if veh.idle:
                 veh.clear_route()
                 veh.rebl = False
@@ -948,44 +1895,30 @@ class Model(object):
         c = np.zeros((Mlat, Mlng,2))
         v = np.zeros((Mlat, Mlng))
         s = np.zeros((Mlat, Mlng))
-        for m in self.M:
-            for i,j in itertools.product(range(Mlat), range(Mlng)):
-                if m[1] <= lat + Mlat*Elat/2 - i*Elat and m[1] >= lat + Mlat*Elat/2 - (i+1)*Elat:
-                    if m[0] >= lng - Mlng*Elng/2 + j*Elng and m[0] <= lng - Mlng*Elng/2 + (j+1)*Elng:
-                        d[i][j] += m[4] * self.D
-                        c[i][j][0] += m[0] * m[4] * self.D
-                        c[i][j][1] += m[1] * m[4] * self.D
-                        break
-        for i,j in itertools.product(range(Mlat), range(Mlng)):
-            if d[i][j] != 0:
-                c[i][j][0] /= d[i][j]
-                c[i][j][1] /= d[i][j]
-            else:
-                c[i][j][0] = False
-                c[i][j][1] = False
+        M = np.array(self.M, dtype=float).reshape(-1, 6)
+        i, j = self.get_moving_cells(lng, lat, M[:, 0], M[:, 1])
+        in_grid = i >= 0
+        np.add.at(d, (i[in_grid], j[in_grid]), (M[:, 4] * self.D)[in_grid])
+        np.add.at(c[:, :, 0], (i[in_grid], j[in_grid]), (M[:, 0] * M[:, 4] * self.D)[in_grid])
+        np.add.at(c[:, :, 1], (i[in_grid], j[in_grid]), (M[:, 1] * M[:, 4] * self.D)[in_grid])
+        # cells without demand have no centroid
+        c[d != 0] /= d[d != 0][:, np.newaxis]
+        c[d == 0] = False
+        idle = []
+        busy = []
+        lngs, lats, ns = self.fleet.get_locations_at_time(self.vehs, self.T+INT_REBL)
         for veh_ in self.vehs:
             if veh_.idle:
-                for i,j in itertools.product(range(Mlat), range(Mlng)):
-                    if veh_.lat <= lat + Mlat*Elat/2 - i*Elat and veh_.lat >= lat + Mlat*Elat/2 - (i+1)*Elat:
-                        if veh_.lng >= lng - Mlng*Elng/2 + j*Elng and veh_.lng <= lng - Mlng*Elng/2 + (j+1)*Elng:
-                            v[i][j] += 1
-                            break
+                idle.append( (veh_.lng, veh_.lat) )
             else:
-                lng_, lat_, n = veh_.get_location_at_time(self.T+INT_REBL)
-                for i,j in itertools.product(range(Mlat), range(Mlat)):
-                    if lat_ <= lat + Mlat*Elat/2 - i*Elat and lat_ >= lat + Mlat*Elat/2 - (i+1)*Elat:
-                        if lng_ >= lng - Mlng*Elng/2 + j*Elng and lng_ <= lng - Mlng*Elng/2 + (j+1)*Elng:
-                            if n == 0:
-                                s[i][j] += 0.8
-                            elif n == 1:
-                                s[i][j] += 0.4
-                            elif n == 2:
-                                s[i][j] += 0.2
-                            elif n == 3:
-                                s[i][j] += 0.1
-                            else:
-                                s[i][j] += 0.0
-                            break
+                busy.append( (lngs[veh_.id], lats[veh_.id], ns[veh_.id]) )
+        idle = np.array(idle, dtype=float).reshape(-1, 2)
+        busy = np.array(busy, dtype=float).reshape(-1, 3)
+        i, j = self.get_moving_cells(lng, lat, idle[:, 0], idle[:, 1])
+        np.add.at(v, (i[i >= 0], j[i >= 0]), 1)
+        i, j = self.get_moving_cells(lng, lat, busy[:, 0], busy[:, 1])
+        avail = np.array([0.8, 0.4, 0.2, 0.1, 0.0])[np.minimum(busy[:, 2].astype(int), 4)]
+        np.add.at(s, (i[i >= 0], j[i >= 0]), avail[i >= 0])
         return [d,v,s], c
 
     # build the rebalancing route according to the action
@@ -1076,4 +2009,24 @@ class Model(object):
         str = "AMoD system at t = %.3f: %d requests, in which %d in queue" % ( self.T, self.N-1, len(self.queue) )
         # for r in self.queue:
         #     str += "\n" + r.__str__()
-        return str
\ No newline at end of file
+        return str
+
+
+# routing engine of a worker process
+worker_osrm = None
+
+# initialize a worker process with its own copy of the routing engine
+def init_worker(osrm):
+    global worker_osrm
+    worker_osrm = pickle.loads(osrm)
+
+# get the best insertion of each request of a batch into each vehicle of a shard, in a worker process
+# return the insertions with the numbers of candidate insertions tested, pruned and checked on the full route
+def insert_shard(shard, reqs, T):
+    inss = [shard.get_insertions(worker_osrm, req, T, shard.vehs) for req in reqs]
+    return inss, shard.n_cand, shard.n_pruned, shard.n_full
+
+# run a chain of simulated annealing on a copy of the model, in a worker process
+def anneal_shard(shard, routes, costs, temp, steps, seed):
+    np.random.seed(seed)
+    return shard.anneal(worker_osrm, DurTable(worker_osrm), routes, costs, temp, steps)
@@ -21,7 +21,9 @@ T_TOTAL = (T_WARM_UP + T_STUDY + T_COOL_DOWN)
 
 # methods for vehicle-request assignment, reoptimization and rebalancing
 # ins = insertion heuristics
-# hsa = hybrid simulated annealing
+# bat = batch assignment, matching the requests of an interval to vehicles at once
+# rtv = request-trip-vehicle assignment, assigning groups of requests that could share a ride
+# hsa = hybrid simulated annealing, lns = large neighborhood search
 # sar = simple anticipatory rebalancing, orp = optimal rebalancing problem, dqn = deep Q network
 MET_ASSIGN = "ins"
 MET_REOPT = "no"
@@ -32,6 +34,23 @@ INT_ASSIGN = 30
 INT_REOPT = 30
 INT_REBL = 150
 
+# wall-clock time budgets of assignment, reoptimization and rebalancing at each interval (in seconds)
+# a phase that runs out of its budget keeps the best solution found so far
+# None for no budget (default), so that the results of a run do not depend on the speed of the machine;
+# set them (e.g. 15.0, 10.0 and 5.0) to bound the time of each interval, as a real-time dispatcher would
+B_ASSIGN = None
+B_REOPT = None
+B_REBL = None
+
+# number of worker processes for the insertion heuristics and simulated annealing, 1 to run serially
+N_WORKER = 1
+
+# wall-clock time budgets of the request-trip-vehicle assignment at each interval (in seconds)
+# for testing which requests could share a ride, and for enumerating the trips of more than one request
+# None for no budget (default), as for the budgets above
+RTV_RR_BUDGET = None
+RTV_TRIP_BUDGET = None
+
 # if road network is enabled, use the routing server; otherwise use Euclidean distance
 IS_ROAD_ENABLED = True
 # if true, activate the animation
@@ -44,6 +63,12 @@ MAX_WAIT = 60*10
 # constant vehicle speed when road network is disabled (in meters/second)
 CST_SPEED = 6
 
+# maximum vehicle speed on the road network, used to bound travel times from below (in meters/second)
+MAX_SPEED = 30
+# maximum distance from a location to the road position it is snapped to by the routing engine (in meters)
+# routes run between snapped positions, so the lower bounds of travel times leave this margin at each end
+SNAP_MARGIN = 100
+
 # probability that a request is sent in advance (otherwise, on demand)
 PROB_ADV = 0.0
 # time before which system gets notified of the in-advance requests
@@ -0,0 +1,401 @@
+"""
+in-process routing engine over a road graph preprocessed from an OpenStreetMap extract
+"""
+
+import os
+import time
+import heapq
+import threading
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from lib.Constants import *
+from lib.OsrmEngine import *
+
+# default speeds (in km/h) of the road types that cars can drive on, as in the osrm car profile
+ROAD_SPEEDS = {
+    "motorway": 90, "motorway_link": 45,
+    "trunk": 85, "trunk_link": 40,
+    "primary": 65, "primary_link": 30,
+    "secondary": 55, "secondary_link": 25,
+    "tertiary": 40, "tertiary_link": 20,
+    "unclassified": 25, "residential": 25,
+    "living_street": 10, "service": 15,
+}
+
+
+class GraphEngine(OsrmEngine):
+    """
+    GraphEngine is a routing engine running inside the simulation process, with no external server
+    It provides the same queries as OsrmEngine, answered by bidirectional Dijkstra on a compressed sparse row (CSR) graph
+    Attributes:
+        map_loc: path of the OpenStreetMap extract (.osm, or .osm.pbf if pyosmium is installed)
+        graph_loc: path of the preprocessed graph, built from the map at the first run
+        lng: longitude of each node
+        lat: latitude of each node
+        indptr: CSR offsets of the outgoing edges of each node
+        indices: head node of each edge
+        dur: duration of each edge (in seconds)
+        dist: distance of each edge (in meters)
+        way: the way each edge belongs to, which delimits the steps of a leg
+        rindptr: CSR offsets of the incoming edges of each node
+        rindices: tail node of each incoming edge
+        redge: index of each incoming edge into the outgoing edge arrays
+        snap: indices of the nodes that origins and destinations are snapped to (the largest connected part of the graph)
+        tree: spatial index over the snappable nodes (None if scipy is not installed)
+    """
+    def __init__(self,
+                 map_loc,
+                 graph_loc = None,
+                 cst_speed = CST_SPEED,
+                 cache_size = 100000,
+                 cache_digits = None,
+                 cache_routes = True,
+                 cache_file = None):
+        if not os.path.isfile(map_loc):
+            raise Exception("Could not find the road network data at %s" % map_loc)
+        self.map_loc = map_loc
+        self.graph_loc = graph_loc if graph_loc is not None else map_loc + ".npz"
+        self.cst_speed = cst_speed
+        self.n_call = 0
+        self.n_fail = 0
+        self.n_timeout = 0
+        self.t_call = 0.0
+        self.t_max = 0.0
+        disk = DiskCache(cache_file, DiskCache.hash_file(map_loc)) if cache_file is not None else None
+        self.cache = LruCache(cache_size, cache_digits, disk)
+        self.cache_routes = cache_routes
+        # queries are computed in this process, so there is nothing to gain from running them concurrently
+        self.client = None
+        self.lock = threading.Lock()
+        self.restart_lock = threading.Lock()
+        self.t_start = 0.0
+        stime = time.time()
+        if not os.path.isfile(self.graph_loc):
+            self.build_graph()
+        self.load_graph()
+        self.t_start = time.time() - stime
+        print("The road graph \"%s\" is loaded in %.2f s: %d nodes, %d edges" % (
+            self.graph_loc, self.t_start, len(self.lng), len(self.indices)))
+
+    # there is no server to start, stop or check
+    def start_server(self):
+        pass
+
+    def kill_server(self):
+        pass
+
+    def check_server(self):
+        return True
+
+    def restart_server(self, port=None):
+        pass
+
+    # read the drivable ways of the map as lists of (node id, lng, lat), with speed (in m/s) and direction
+    # direction is 1 (one way), -1 (one way against the order of the nodes) or 0 (both ways)
+    def read_ways(self):
+        ways = []
+        if self.map_loc.endswith(".pbf"):
+            try:
+                import osmium
+            except ImportError:
+                raise Exception("Reading %s requires pyosmium; convert it to .osm or install osmium" % self.map_loc)
+            class Handler(osmium.SimpleHandler):
+                def way(self, w):
+                    tags = {t.k: t.v for t in w.tags}
+                    road = get_road(tags)
+                    if road is not None:
+                        ways.append(([(n.ref, n.lon, n.lat) for n in w.nodes if n.location.valid()],) + road)
+            Handler().apply_file(self.map_loc, locations=True)
+        else:
+            coords = {}
+            for event, elem in ET.iterparse(self.map_loc, events=("end",)):
+                if elem.tag == "node":
+                    coords[int(elem.get("id"))] = (float(elem.get("lon")), float(elem.get("lat")))
+                    elem.clear()
+                elif elem.tag == "way":
+                    tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+                    road = get_road(tags)
+                    if road is not None:
+                        nodes = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                        ways.append(([(n,) + coords[n] for n in nodes if n in coords],) + road)
+                    elem.clear()
+        return ways
+
+    # build the CSR graph from the map and save it
+    def build_graph(self):
+        ways = self.read_ways()
+        us = []
+        vs = []
+        ws = []
+        speeds = []
+        ids = {}
+        lngs = []
+        lats = []
+        for w, (nodes, speed, direction) in enumerate(ways):
+            for (n, lng, lat) in nodes:
+                if n not in ids:
+                    ids[n] = len(lngs)
+                    lngs.append(lng)
+                    lats.append(lat)
+            for (a, b) in zip(nodes[:-1], nodes[1:]):
+                if direction >= 0:
+                    us.append(ids[a[0]])
+                    vs.append(ids[b[0]])
+                    ws.append(w)
+                    speeds.append(speed)
+                if direction <= 0:
+                    us.append(ids[b[0]])
+                    vs.append(ids[a[0]])
+                    ws.append(w)
+                    speeds.append(speed)
+        lng = np.array(lngs)
+        lat = np.array(lats)
+        us = np.array(us, dtype=np.int64)
+        vs = np.array(vs, dtype=np.int64)
+        dist = 6371000*2*np.pi/360 * np.sqrt( (np.cos((lat[us]+lat[vs])*np.pi/360)*(lng[us]-lng[vs]))**2 + (lat[us]-lat[vs])**2 )
+        dur = dist / np.array(speeds)
+        # sort the edges by tail node for the forward graph, and by head node for the backward graph
+        order = np.argsort(us, kind="stable")
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(us, minlength=len(lng)))))
+        rorder = np.argsort(vs[order], kind="stable")
+        rindptr = np.concatenate(([0], np.cumsum(np.bincount(vs, minlength=len(lng)))))
+        np.savez_compressed(self.graph_loc,
+                            lng=lng, lat=lat,
+                            indptr=indptr, indices=vs[order], dur=dur[order], dist=dist[order], way=np.array(ws)[order],
+                            rindptr=rindptr, rindices=us[order][rorder], redge=rorder,
+                            snap=self.get_largest_component(len(lng), us, vs))
+
+    # get the nodes of the largest strongly connected component, so that every snapped pair is connected
+    def get_largest_component(self, n, us, vs):
+        try:
+            from scipy.sparse import csr_matrix
+            from scipy.sparse.csgraph import connected_components
+        except ImportError:
+            return np.arange(n)
+        m = csr_matrix((np.ones(len(us)), (us, vs)), shape=(n, n))
+        ncomp, labels = connected_components(m, directed=True, connection="strong")
+        return np.flatnonzero(labels == np.argmax(np.bincount(labels)))
+
+    # load the preprocessed graph
+    def load_graph(self):
+        g = np.load(self.graph_loc)
+        self.lng = g["lng"]
+        self.lat = g["lat"]
+        self.indptr = g["indptr"]
+        self.indices = g["indices"]
+        self.dur = g["dur"]
+        self.dist = g["dist"]
+        self.way = g["way"]
+        self.rindptr = g["rindptr"]
+        self.rindices = g["rindices"]
+        self.redge = g["redge"]
+        self.snap = g["snap"]
+        # plain lists are much faster than numpy arrays to index one element at a time in the search
+        self.adj = (self.indptr.tolist(), self.indices.tolist(), self.dur.tolist())
+        self.radj = (self.rindptr.tolist(), self.rindices.tolist(), self.dur[self.redge].tolist())
+        self.redge_list = self.redge.tolist()
+        self.tail = np.repeat(np.arange(len(self.lng)), np.diff(self.indptr)).tolist()
+        self.coords = np.column_stack((self.lng, self.lat)).tolist()
+        # nodes are indexed in a locally flat projection, so that Euclidean distance approximates the ground distance
+        self.kx = np.cos(np.mean(self.lat) * np.pi / 180)
+        xy = np.column_stack((self.lng[self.snap] * self.kx, self.lat[self.snap]))
+        try:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(xy)
+        except ImportError:
+            self.tree = None
+            self.xy = xy
+
+    # get the nearest node of a location
+    def snap_node(self, lng, lat):
+        if self.tree is not None:
+            k = self.tree.query((lng * self.kx, lat))[1]
+        else:
+            k = np.argmin( (self.xy[:, 0] - lng * self.kx)**2 + (self.xy[:, 1] - lat)**2 )
+        return int(self.snap[k])
+
+    # find the shortest (in time) path between two nodes with bidirectional Dijkstra
+    # returns the list of edges along the path, or None if the destination is unreachable
+    def shortest_path(self, s, t):
+        if s == t:
+            return []
+        indptr, indices, dur = self.adj
+        rindptr, rindices, rdur = self.radj
+        dist_f = {s: 0.0}
+        dist_b = {t: 0.0}
+        pred_f = {s: -1}
+        pred_b = {t: -1}
+        heap_f = [(0.0, s)]
+        heap_b = [(0.0, t)]
+        best = np.inf
+        meet = -1
+        while heap_f and heap_b:
+            if heap_f[0][0] + heap_b[0][0] >= best:
+                break
+            # expand the side whose frontier is closer
+            if heap_f[0][0] <= heap_b[0][0]:
+                d, u = heapq.heappop(heap_f)
+                if d > dist_f[u]:
+                    continue
+                for e in range(indptr[u], indptr[u+1]):
+                    v = indices[e]
+                    d_ = d + dur[e]
+                    if d_ < dist_f.get(v, np.inf):
+                        dist_f[v] = d_
+                        pred_f[v] = e
+                        heapq.heappush(heap_f, (d_, v))
+                        if v in dist_b and d_ + dist_b[v] < best:
+                            best = d_ + dist_b[v]
+                            meet = v
+            else:
+                d, u = heapq.heappop(heap_b)
+                if d > dist_b[u]:
+                    continue
+                for e in range(rindptr[u], rindptr[u+1]):
+                    v = rindices[e]
+                    d_ = d + rdur[e]
+                    if d_ < dist_b.get(v, np.inf):
+                        dist_b[v] = d_
+                        pred_b[v] = self.redge_list[e]
+                        heapq.heappush(heap_b, (d_, v))
+                        if v in dist_f and d_ + dist_f[v] < best:
+                            best = d_ + dist_f[v]
+                            meet = v
+        if meet == -1:
+            return None
+        # walk back from the meeting node to both ends
+        edges = []
+        v = meet
+        while pred_f[v] != -1:
+            e = pred_f[v]
+            edges.append(e)
+            v = self.tail[e]
+        edges.reverse()
+        v = meet
+        while pred_b[v] != -1:
+            e = pred_b[v]
+            edges.append(e)
+            v = indices[e]
+        return edges
+
+    # route between two locations and return the leg in the format of the osrm route service
+    # consecutive edges of the same way form a step, and the leg ends with an arrival step of two identical points
+    def route_leg(self, olng, olat, dlng, dlat):
+        stime = time.time()
+        s = self.snap_node(olng, olat)
+        t = self.snap_node(dlng, dlat)
+        edges = self.shortest_path(s, t)
+        with self.lock:
+            self.n_call += 1
+            dt = time.time() - stime
+            self.t_call += dt
+            self.t_max = max(self.t_max, dt)
+            if edges is None:
+                self.n_fail += 1
+                return None
+        steps = []
+        way = None
+        for e in edges:
+            if self.way[e] != way:
+                way = self.way[e]
+                steps.append({"distance": 0.0, "duration": 0.0,
+                              "geometry": {"coordinates": [list(self.coords[self.tail[e]])]}})
+            steps[-1]["distance"] += float(self.dist[e])
+            steps[-1]["duration"] += float(self.dur[e])
+            steps[-1]["geometry"]["coordinates"].append(list(self.coords[self.adj[1][e]]))
+        if len(steps) == 0:
+            steps.append({"distance": 0.0, "duration": 0.0,
+                          "geometry": {"coordinates": [list(self.coords[s]), list(self.coords[s])]}})
+        end = list(self.coords[t])
+        steps.append({"distance": 0.0, "duration": 0.0, "geometry": {"coordinates": [end, list(end)]}})
+        return {"distance": sum(step["distance"] for step in steps),
+                "duration": sum(step["duration"] for step in steps),
+                "steps": steps}
+
+    # get the best route from origin to destination
+    def get_routing(self, olng, olat, dlng, dlat):
+        key = self.cache.get_key("route", olng, olat, dlng, dlat)
+        leg = self.cache.get(key) if self.cache_routes else None
+        if leg is None:
+            leg = self.route_leg(olng, olat, dlng, dlat)
+            if leg is None:
+                return None
+            if self.cache_routes:
+                self.cache.put(key, leg)
+            self.cache.put(self.cache.get_key("dd", olng, olat, dlng, dlat), (leg['distance'], leg['duration']))
+            self.cache.put(self.cache.get_key("t", olng, olat, dlng, dlat), leg['duration'])
+        return copy.deepcopy(leg) if self.cache_routes else leg
+
+    # get the best routes through a series of waypoints
+    def get_route_legs(self, coords):
+        legs = [self.get_routing(olng, olat, dlng, dlat) for ((olng, olat), (dlng, dlat)) in zip(coords[:-1], coords[1:])]
+        return None if None in legs else legs
+
+    # get both distance and duration
+    def get_distance_duration(self, olng, olat, dlng, dlat):
+        if IS_ROAD_ENABLED:
+            key = self.cache.get_key("dd", olng, olat, dlng, dlat)
+            dd = self.cache.get(key)
+            if dd is None:
+                leg = self.get_routing(olng, olat, dlng, dlat)
+                if leg is None:
+                    return None
+                dd = (leg['distance'], leg['duration'])
+            return dd
+        else:
+            return self.get_distance(olng, olat, dlng, dlat), self.get_duration(olng, olat, dlng, dlat)
+
+    # get the durations of the best routes from each source to each destination
+    # with scipy, one-to-all searches run in compiled code; otherwise, each pair is routed on its own
+    # tables are not cached, so with cached_only there is nothing to return
+    def get_duration_matrix(self, sources, destinations, cached_only=False):
+        if not IS_ROAD_ENABLED:
+            return super().get_duration_matrix(sources, destinations)
+        if cached_only:
+            return None
+        try:
+            from scipy.sparse import csr_matrix
+            from scipy.sparse.csgraph import dijkstra
+        except ImportError:
+            mat = np.zeros((len(sources), len(destinations)))
+            for i, (olng, olat) in enumerate(sources):
+                for j, (dlng, dlat) in enumerate(destinations):
+                    dt = self.get_duration(olng, olat, dlng, dlat)
+                    mat[i][j] = dt if dt is not None else np.inf
+            return mat
+        if not hasattr(self, "csr"):
+            # keep the fastest of parallel edges, since scipy would add them up, and keep zero durations as edges
+            us = np.repeat(np.arange(len(self.lng)), np.diff(self.indptr))
+            order = np.lexsort((self.dur, self.indices, us))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (us[order][1:] != us[order][:-1]) | (self.indices[order][1:] != self.indices[order][:-1])
+            order = order[first]
+            self.csr = csr_matrix((np.maximum(self.dur[order], 1e-9), (us[order], self.indices[order])),
+                                  shape=(len(self.lng), len(self.lng)))
+        s = [self.snap_node(lng, lat) for (lng, lat) in sources]
+        t = [self.snap_node(lng, lat) for (lng, lat) in destinations]
+        us, inv = np.unique(s, return_inverse=True)
+        return dijkstra(self.csr, directed=True, indices=us)[inv][:, t]
+
+
+# get the speed (in m/s) and direction of a way from its tags, or None if cars cannot drive on it
+def get_road(tags):
+    highway = tags.get("highway")
+    if highway not in ROAD_SPEEDS or tags.get("access") in ("no", "private") or tags.get("area") == "yes":
+        return None
+    speed = ROAD_SPEEDS[highway]
+    try:
+        speed = min(speed, float(tags.get("maxspeed", "").split()[0]) * (1.609 if "mph" in tags["maxspeed"] else 1.0))
+    except (ValueError, IndexError):
+        pass
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "true", "1"):
+        direction = 1
+    elif oneway == "-1":
+        direction = -1
+    elif oneway == "no":
+        direction = 0
+    else:
+        direction = 1 if highway in ("motorway", "motorway_link") or tags.get("junction") == "roundabout" else 0
+    return speed / 3.6, direction
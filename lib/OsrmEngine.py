@@ -3,15 +3,210 @@ Open Source Routing Machine (OSRM)
 """
 
 import os
+import hashlib
+import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
 import math
+import copy
+import threading
 import numpy as np
-from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import subprocess
+from subprocess import Popen, PIPE, DEVNULL
 
 from lib.Constants import *
 
+class DiskCache(object):
+    """
+    DiskCache is a persistent store of routing results in an SQLite database, shared across simulation runs
+    The database is in WAL mode, so that several simulation processes can read it while one of them writes
+    Writes are buffered and committed in short transactions, so that the write lock is never held between them
+    Attributes:
+        path: path of the database file
+        map_hash: hash of the road network file, so that results of different maps never mix
+        conn: connection to the database
+        pending: rows written but not yet committed
+        commit_every: number of buffered writes after which they are committed
+        commit_interval: time after which buffered writes are committed (in seconds)
+        t_commit: time of the last commit
+        n_dropped: number of writes dropped because the database was locked by another process
+    """
+    def __init__(self, path, map_hash, commit_every=100, commit_interval=1.0, busy_timeout=0.1):
+        self.path = path
+        self.map_hash = map_hash
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending = []
+        self.t_commit = time.time()
+        self.n_dropped = 0
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS routes ("
+                              "map TEXT, query TEXT, olng REAL, olat REAL, dlng REAL, dlat REAL, value TEXT, "
+                              "PRIMARY KEY (map, query, olng, olat, dlng, dlat)) WITHOUT ROWID")
+
+    # compute the hash of the road network file
+    @staticmethod
+    def hash_file(path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # json has no tuples, so (distance, duration) pairs are restored here
+    @staticmethod
+    def decode(query, value):
+        value = json.loads(value)
+        return tuple(value) if query == "dd" else value
+
+    # return the stored value of a key from LruCache.get_key(), or None if not found (or if the database is busy)
+    def get(self, key):
+        try:
+            row = self.conn.execute("SELECT value FROM routes WHERE map=? AND query=? AND olng=? AND olat=? AND dlng=? AND dlat=?",
+                                    (self.map_hash,) + key).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return self.decode(key[0], row[0]) if row is not None else None
+
+    # buffer a value; the first writer of a key wins, which is fine since routing is deterministic
+    def put(self, key, value):
+        self.pending.append((self.map_hash,) + key + (json.dumps(value),))
+        if len(self.pending) >= self.commit_every or time.time() - self.t_commit >= self.commit_interval:
+            self.flush()
+
+    # commit the buffered writes in one short transaction, so that other processes can see them
+    # if another process holds the write lock beyond the busy timeout, the writes are dropped rather than
+    # stalling or crashing the simulation, as they are only a cache
+    def flush(self):
+        rows, self.pending = self.pending, []
+        if len(rows) > 0:
+            try:
+                with self.conn:
+                    self.conn.executemany("INSERT OR IGNORE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.OperationalError:
+                self.n_dropped += len(rows)
+        self.t_commit = time.time()
+
+    # iterate over (at most max_size) stored entries of this map, for warm-starting the memory cache
+    def load(self, max_size):
+        for row in self.conn.execute("SELECT query, olng, olat, dlng, dlat, value FROM routes WHERE map=? LIMIT ?",
+                                     (self.map_hash, max_size)):
+            yield tuple(row[:5]), self.decode(row[0], row[5])
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class LruCache(object):
+    """
+    LruCache is a bounded cache of routing results, evicting the least recently used entry when full
+    Attributes:
+        max_size: maximum number of entries (0 disables the cache)
+        digits: number of decimal digits the coordinates are rounded to in the keys (None for exact coordinates)
+        entries: the cached entries, ordered from least to most recently used
+        hits: number of lookups found in the cache
+        misses: number of lookups not found in the cache
+        disk: optional persistent cache behind this one
+        disk_hits: number of lookups missed in memory but found on disk
+        lock: lock guarding the entries, as queries may be sent from several threads
+    """
+    def __init__(self, max_size=100000, digits=None, disk=None):
+        self.max_size = max_size
+        self.digits = digits
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk = disk
+        self.disk_hits = 0
+        # warm start from the results of previous runs
+        if self.disk is not None and self.max_size > 0:
+            for key, value in self.disk.load(self.max_size):
+                self.entries[key] = value
+
+    # build the key of a query from origin to destination
+    def get_key(self, query, olng, olat, dlng, dlat):
+        if self.digits is None:
+            return (query, olng, olat, dlng, dlat)
+        else:
+            return (query, round(olng, self.digits), round(olat, self.digits),
+                    round(dlng, self.digits), round(dlat, self.digits))
+
+    # return the cached value, or None if not found
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None and self.disk is not None:
+                value = self.disk.get(key)
+                if value is not None:
+                    self.disk_hits += 1
+                    self.put(key, value, persist=False)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+            return value
+
+    # add a value, and evict the least recently used entries if the cache is full
+    # if persist, the value is also written through to the disk cache
+    def put(self, key, value, persist=True):
+        if value is None:
+            return
+        with self.lock:
+            if persist and self.disk is not None:
+                self.disk.put(key, value)
+            if self.max_size <= 0:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # check if a key is cached in memory, without counting a lookup
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ConcurrentOsrmClient(object):
+    """
+    ConcurrentOsrmClient submits independent routing queries concurrently to a long-lived thread pool
+    The blocking http calls run on the pool, so the routing server (multithreaded) serves them in parallel
+    Attributes:
+        max_inflight: maximum number of queries in flight at a time
+        executor: thread pool running the queries, kept for the lifetime of the client
+    """
+    def __init__(self, max_inflight=8):
+        self.max_inflight = max_inflight
+        self.executor = ThreadPoolExecutor(max_workers=max_inflight)
+
+    # run func(*args) for each args in args_list concurrently, and return the results in order
+    # the pool size bounds the queries in flight
+    def gather(self, func, args_list):
+        return list(self.executor.map(lambda args: func(*args), args_list))
+
+    def close(self):
+        self.executor.shutdown()
+
+
 class OsrmEngine(object):
     """
     OsrmEngine is the class for the routing server
@@ -21,13 +216,38 @@ class OsrmEngine(object):
         ghost: host ip address
         gport: host port
         cst_speed: constant vehicle speed when road network is disabled (in meters/second
+        timeout: timeout of a single call to the routing server (in seconds)
+        session: keep-alive http session with a pool of connections to the routing server
+        n_call: number of calls sent to the routing server
+        n_fail: number of calls that failed
+        n_timeout: number of calls that timed out or lost their connection
+        t_call: accumulated latency of all calls (in seconds)
+        t_max: maximum latency of a single call (in seconds)
+        cache: LRU cache of distances, durations and (optionally) leg geometries
+        cache_routes: if true, also cache the full legs returned by get_routing
+        cache_file: optional path of an SQLite database persisting the cache across runs
+        client: client for submitting independent queries concurrently (None if max_inflight <= 1)
+        lock: lock guarding the call statistics
+        restart_lock: lock serializing the restarts of the routing server, as calls may time out in several threads at once
+        start_timeout: maximum time to wait for the routing server to start or stop (in seconds)
+        proc: process handle of the routing server started by this engine
+        t_start: time the routing server took to start (in seconds)
     """
     def __init__(self,
                  exe_loc,
                  map_loc,
                  ghost = '0.0.0.0',
                  gport = 5000,
-                 cst_speed = CST_SPEED):
+                 cst_speed = CST_SPEED,
+                 pool_size = 10,
+                 timeout = 1,
+                 retries = 3,
+                 cache_size = 100000,
+                 cache_digits = None,
+                 cache_routes = True,
+                 cache_file = None,
+                 max_inflight = 8,
+                 start_timeout = 60):
         if not os.path.isfile(exe_loc):
             raise Exception("Could not find the routing server at %s" % exe_loc)
         else:
@@ -39,27 +259,98 @@ class OsrmEngine(object):
         self.ghost = ghost
         self.gport = gport
         self.cst_speed = cst_speed
+        self.timeout = timeout
+        # reuse connections across calls, and retry on failed connections with a short backoff
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, connect=retries, read=0, backoff_factor=0.1))
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.n_call = 0
+        self.n_fail = 0
+        self.n_timeout = 0
+        self.t_call = 0.0
+        self.t_max = 0.0
+        disk = DiskCache(cache_file, DiskCache.hash_file(map_loc)) if cache_file is not None else None
+        self.cache = LruCache(cache_size, cache_digits, disk)
+        self.cache_routes = cache_routes
+        self.client = ConcurrentOsrmClient(max_inflight) if max_inflight > 1 else None
+        self.lock = threading.Lock()
+        self.restart_lock = threading.Lock()
+        self.start_timeout = start_timeout
+        self.proc = None
+        self.t_start = 0.0
         # remove any open instance
         if self.check_server():
             self.kill_server()
 
-    # kill any routing server currently running before starting something new
+    # a copy of the engine, e.g. in a worker process, gets its own connections and an empty in-memory cache,
+    # and leaves the routing server to this engine
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("session", "lock", "restart_lock", "client", "cache", "proc", "procs"):
+            state.pop(key, None)
+        state["cache_size"] = self.cache.max_size
+        state["cache_digits"] = self.cache.digits
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.restart_lock = threading.Lock()
+        self.client = None
+        self.cache = LruCache(self.__dict__.pop("cache_size"), self.__dict__.pop("cache_digits"))
+        self.proc = None
+        if "n_server" in state:
+            self.procs = [None] * self.n_server
+
+    # kill the routing server started by this engine, or any routing server running if it was started elsewhere
     def kill_server(self):
-        Popen(["killall", os.path.basename(self.exe_loc)], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        time.sleep(2)
+        if self.proc is not None:
+            self.stop_process(self.proc)
+            self.proc = None
+        else:
+            Popen(["killall", os.path.basename(self.exe_loc)], stdin=PIPE, stdout=PIPE, stderr=PIPE).wait()
+        self.wait_for_server(self.gport, up=False)
         print( "The routing server \"http://%s:%d\" is killed" % (self.ghost, self.gport) )
-        
-    # check if server is already running
-    def check_server(self):
+
+    # terminate a process gracefully, and kill it if it does not exit in time
+    def stop_process(self, proc):
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    # check if a server responds on the port, without retrying
+    def probe_server(self, port):
         try:
-             if requests.get("http://%s:%d" % (self.ghost, self.gport)).status_code == 400:
-                return True
-        except requests.ConnectionError:
+            return requests.get("http://%s:%d" % (self.ghost, port), timeout=self.timeout).status_code == 400
+        except requests.RequestException:
             return False
+
+    # check if server is already running
+    def check_server(self):
+        return self.probe_server(self.gport)
+
+    # poll the server on the port until it is up (or down), with exponential backoff
+    # returns the time waited; raises if the process exits or the deadline passes
+    def wait_for_server(self, port, up=True, proc=None):
+        stime = time.time()
+        delay = 0.005
+        while self.probe_server(port) != up:
+            if proc is not None and proc.poll() is not None:
+                raise Exception("Map could not be loaded")
+            if time.time() - stime > self.start_timeout:
+                raise Exception("The routing server \"http://%s:%d\" did not %s within %d s" % (
+                    self.ghost, port, "start" if up else "stop", self.start_timeout))
+            time.sleep(delay)
+            delay = min(2*delay, 0.5)
+        return time.time() - stime
     
-    # start the routing server
-    def start_server(self):
-        # check file
+    # check the version of the routing server
+    def check_version(self):
         try:
             p = Popen([self.exe_loc, '-v'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
             output = p.communicate()[0].decode("utf-8")
@@ -67,68 +358,172 @@ class OsrmEngine(object):
             output = ""
         if "v5.11.0" not in str(output):
             raise Exception("osrm does not have the right version")
+
+    # start the routing server
+    def start_server(self):
+        # check file
+        self.check_version()
         # check no running server
         if self.check_server():
             raise Exception("osrm-routed already running")
-        # start server
-        p = Popen([self.exe_loc, self.map_loc], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        time.sleep(2)
-        if requests.get("http://%s:%d" % (self.ghost, self.gport)).status_code == 400:
-            print( "The routing server \"http://%s:%d\" starts running" % (self.ghost, self.gport) )
-        else:
-            raise Exception("Map could not be loaded")
+        # start server, discarding its log so that it never blocks on a full pipe
+        self.proc = Popen([self.exe_loc, '-i', self.ghost, '-p', str(self.gport), self.map_loc],
+                          stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+        self.t_start = self.wait_for_server(self.gport, proc=self.proc)
+        print( "The routing server \"http://%s:%d\" starts running in %.2f s" % (self.ghost, self.gport, self.t_start) )
     
-    # restart the routing server        
-    def restart_server(self):
+    # restart the routing server
+    # port is the server that failed, which does not matter as there is only one
+    def restart_server(self, port=None):
         self.kill_server()
         self.start_server()
+
+    # restart the routing server on the port after a call to it timed out and it did not respond
+    # calls that time out together in several threads wait for the first one to restart the server,
+    # and the others find it up again when they probe it under the lock
+    def recover_server(self, port):
+        with self.restart_lock:
+            if not self.probe_server(port):
+                self.restart_server(port)
+
+    # pick the server (host, port) that the next call is sent to
+    def acquire_server(self):
+        return (self.ghost, self.gport)
+
+    # notify that the call sent to the server (host, port) is finished
+    def release_server(self, server):
+        pass
     
-    # generate the request in url format        
+    # generate the request in url format, relative to the server it will be sent to
     def create_url(self, olng, olat, dlng, dlat, steps="false", annotations="false"):
-        return "http://{0}:{1}/route/v1/driving/{2},{3};{4},{5}?alternatives=false&steps={6}&annotations={7}&geometries=geojson".format(
-            self.ghost, self.gport, olng, olat, dlng, dlat, steps, annotations)
+        return "/route/v1/driving/{0},{1};{2},{3}?alternatives=false&steps={4}&annotations={5}&geometries=geojson".format(
+            olng, olat, dlng, dlat, steps, annotations)
 
-    # send the request and get the response in Json format
-    def call_url(self, url):
+    # generate the request through a series of waypoints in url format, where coords is a list of (lng, lat)
+    # u-turns are allowed at the waypoints, so that each leg is the best route between its two waypoints
+    # as in create_url(), rather than a continuation of the previous leg
+    def create_multi_url(self, coords, steps="false", annotations="false"):
+        return "/route/v1/driving/{0}?alternatives=false&continue_straight=false&steps={1}&annotations={2}&geometries=geojson".format(
+            ";".join("{0},{1}".format(lng, lat) for (lng, lat) in coords),
+            steps, annotations)
+
+    # generate the table request in url format, where coords is a list of (lng, lat)
+    # sources and destinations are lists of indices into coords
+    def create_table_url(self, coords, sources, destinations):
+        return "/table/v1/driving/{0}?sources={1}&destinations={2}".format(
+            ";".join("{0},{1}".format(lng, lat) for (lng, lat) in coords),
+            ";".join(str(i) for i in sources),
+            ";".join(str(i) for i in destinations))
+
+    # send the request to a server and get the response in Json format
+    def call_url(self, path):
         count = 0
         while count < 10:
+            server = self.acquire_server()
+            url = "http://%s:%d%s" % (server[0], server[1], path)
+            stime = time.time()
             try:
-                response = requests.get(url, timeout=1)
+                response = self.session.get(url, timeout=self.timeout)
                 json_response = response.json()
                 code = json_response['code']
                 if code == 'Ok':
                     return (json_response, True)
                 else:
+                    with self.lock:
+                        self.n_fail += 1
                     print("Error: %s" % (json_response['message']))
                     return (json_response, False)
-            except requests.exceptions.Timeout:
+            # read timeouts exhaust the retries of the session, so they surface as connection errors
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                with self.lock:
+                    self.n_timeout += 1
                 print(url)
-                self.restart_server()
+                # a slow query does not mean the server is down, so only restart it if it does not respond
+                if not self.probe_server(server[1]):
+                    self.recover_server(server[1])
                 count += 1
             except Exception as err:
+                with self.lock:
+                    self.n_fail += 1
                 print("Failed: %s" % (url))
                 return (None, False)
-        print("The routing server \"http://%s:%d\" fails after 10 retries... :(" % (self.ghost, self.gport) )
+            finally:
+                self.release_server(server)
+                dt = time.time() - stime
+                with self.lock:
+                    self.n_call += 1
+                    self.t_call += dt
+                    self.t_max = max(self.t_max, dt)
+        print("The routing server \"http://%s:%d\" fails after 10 retries... :(" % (server[0], server[1]) )
+        return (None, False)
+
+    # get the counters and latency statistics of the calls sent to the routing server
+    def get_call_stats(self):
+        return {"calls": self.n_call,
+                "fails": self.n_fail,
+                "timeouts": self.n_timeout,
+                "total_latency": self.t_call,
+                "mean_latency": self.t_call / self.n_call if self.n_call > 0 else 0.0,
+                "max_latency": self.t_max}
 
-    # get the best route from origin to destination 
+    # get the hit/miss statistics of the routing cache
+    def get_cache_stats(self):
+        lookups = self.cache.hits + self.cache.misses
+        return {"entries": len(self.cache),
+                "hits": self.cache.hits,
+                "misses": self.cache.misses,
+                "disk_hits": self.cache.disk_hits,
+                "disk_dropped": self.cache.disk.n_dropped if self.cache.disk is not None else 0,
+                "hit_rate": self.cache.hits / lookups if lookups > 0 else 0.0}
+
+    # commit the results cached on disk, if any
+    def flush_cache(self):
+        if self.cache.disk is not None:
+            self.cache.disk.flush()
+
+    # get the best route from origin to destination
+    # the leg is copied out of the cache, since vehicles modify the geometry of their steps while moving
     def get_routing(self, olng, olat, dlng, dlat):
-        url = self.create_url(olng, olat, dlng, dlat, steps="true", annotations="false")
-        (response, code) = self.call_url(url)
-        if code:
-            return response['routes'][0]['legs'][0]
-        else:
-            return None
+        key = self.cache.get_key("route", olng, olat, dlng, dlat) if self.cache_routes else None
+        leg = self.cache.get(key) if self.cache_routes else None
+        if leg is None:
+            url = self.create_url(olng, olat, dlng, dlat, steps="true", annotations="false")
+            (response, code) = self.call_url(url)
+            if not code:
+                return None
+            leg = response['routes'][0]['legs'][0]
+            if self.cache_routes:
+                self.cache.put(key, leg)
+                self.cache.put(self.cache.get_key("dd", olng, olat, dlng, dlat), (leg['distance'], leg['duration']))
+                self.cache.put(self.cache.get_key("t", olng, olat, dlng, dlat), leg['duration'])
+        return copy.deepcopy(leg) if self.cache_routes else leg
     
+    # get the best routes through a series of waypoints in a single call
+    # coords is a list of (lng, lat); returns a list of len(coords)-1 legs, one for each pair of consecutive waypoints
+    def get_route_legs(self, coords):
+        keys = [self.cache.get_key("route", olng, olat, dlng, dlat) for ((olng, olat), (dlng, dlat)) in zip(coords[:-1], coords[1:])]
+        legs = [self.cache.get(key) for key in keys] if self.cache_routes else [None]
+        if None in legs:
+            url = self.create_multi_url(coords, steps="true", annotations="false")
+            (response, code) = self.call_url(url)
+            if not code:
+                return None
+            legs = response['routes'][0]['legs']
+            if not self.cache_routes:
+                return legs
+            # the legs are independent best routes (see create_multi_url), so they can be shared with pair queries
+            for ((olng, olat), (dlng, dlat)), key, leg in zip(zip(coords[:-1], coords[1:]), keys, legs):
+                self.cache.put(key, leg)
+                self.cache.put(self.cache.get_key("dd", olng, olat, dlng, dlat), (leg['distance'], leg['duration']))
+                self.cache.put(self.cache.get_key("t", olng, olat, dlng, dlat), leg['duration'])
+        return copy.deepcopy(legs)
+
     # get the distance of the best route from origin to destination
     # if road network is not enabled, return Euclidean distance
     def get_distance(self, olng, olat, dlng, dlat):
         if IS_ROAD_ENABLED:
-            url = self.create_url(olng, olat, dlng, dlat, steps="false", annotations="false")
-            (response, code) = self.call_url(url)
-            if code:
-                return response['routes'][0]['distance']
-            else:
-                return None
+            dd = self.get_distance_duration(olng, olat, dlng, dlat)
+            return dd[0] if dd is not None else None
         else:
             return (6371000*2*math.pi/360 * np.sqrt( (math.cos((olat+dlat)*math.pi/360)*(olng-dlng))**2 + (olat-dlat)**2))
     
@@ -136,24 +531,231 @@ class OsrmEngine(object):
     # if road network is not enabled, return the duration based on Euclidean distance and constant speed   
     def get_duration(self, olng, olat, dlng, dlat):
         if IS_ROAD_ENABLED:
-            url = self.create_url(olng, olat, dlng, dlat, steps="false", annotations="false")
-            (response, code) = self.call_url(url)
-            if code:
-                return response['routes'][0]['duration']
-            else:
-                return None
+            dd = self.get_distance_duration(olng, olat, dlng, dlat)
+            return dd[1] if dd is not None else None
         else:
             return self.get_distance(olng, olat, dlng, dlat) / self.cst_speed
     
     # get both distance and duration
     def get_distance_duration(self, olng, olat, dlng, dlat):
         if IS_ROAD_ENABLED:
+            key = self.cache.get_key("dd", olng, olat, dlng, dlat)
+            dd = self.cache.get(key)
+            if dd is not None:
+                return dd
             url = self.create_url(olng, olat, dlng, dlat, steps="false", annotations="false")
             (response, code) = self.call_url(url)
             if code:
-                return (response['routes'][0]['distance'], response['routes'][0]['duration'])
+                dd = (response['routes'][0]['distance'], response['routes'][0]['duration'])
+                self.cache.put(key, dd)
+                self.cache.put(self.cache.get_key("t", olng, olat, dlng, dlat), dd[1])
+                return dd
             else:
                 return None
         else:
-            return self.get_distance(olng, olat, dlng, dlat), self.get_duration(olng, olat, dlng, dlat) 
-            
+            d = self.get_distance(olng, olat, dlng, dlat)
+            return d, d / self.cst_speed
+
+    # get the Euclidean distances between arrays of origins and destinations, by numpy broadcasting
+    # e.g. olng, olat of shape (n, 1) and dlng, dlat of shape (1, m) give an n x m matrix
+    def get_euclidean_distance(self, olng, olat, dlng, dlat):
+        return 6371000*2*np.pi/360 * np.sqrt( (np.cos((olat+dlat)*np.pi/360)*(olng-dlng))**2 + (olat-dlat)**2 )
+
+    # get the Euclidean distances from each source to each destination
+    # sources and destinations are lists (or n x 2 arrays) of (lng, lat)
+    def get_euclidean_matrix(self, sources, destinations):
+        o = np.asarray(sources, dtype=float).reshape(-1, 2)
+        d = np.asarray(destinations, dtype=float).reshape(-1, 2)
+        return self.get_euclidean_distance(o[:, 0:1], o[:, 1:2], d[:, 0][np.newaxis, :], d[:, 1][np.newaxis, :])
+
+    # get the durations of the best routes from each source to each destination in a single call
+    # sources and destinations are lists of (lng, lat); returns a len(sources) x len(destinations) array
+    # if road network is not enabled, return the durations based on Euclidean distance and constant speed
+    # if cached_only, return None unless all durations are cached in memory, without calling the routing server
+    def get_duration_matrix(self, sources, destinations, cached_only=False):
+        if IS_ROAD_ENABLED:
+            if cached_only and not all(self.cache.get_key("t", olng, olat, dlng, dlat) in self.cache
+                                       for (olng, olat) in sources for (dlng, dlat) in destinations):
+                return None
+            # skip the call if all durations are known from earlier tables or routes
+            mat = np.zeros((len(sources), len(destinations)))
+            keys = {}
+            for i, (olng, olat) in enumerate(sources):
+                for j, (dlng, dlat) in enumerate(destinations):
+                    key = self.cache.get_key("t", olng, olat, dlng, dlat)
+                    dt = self.cache.get(key)
+                    if dt is None:
+                        keys[(i, j)] = key
+                    else:
+                        mat[i][j] = dt
+            if len(keys) == 0:
+                return mat
+            # send each distinct coordinate only once
+            coords = list(dict.fromkeys(list(sources) + list(destinations)))
+            index = {loc: i for i, loc in enumerate(coords)}
+            url = self.create_table_url(coords,
+                                        [index[loc] for loc in sources],
+                                        [index[loc] for loc in destinations])
+            (response, code) = self.call_url(url)
+            if code:
+                mat = np.array(response['durations'], dtype=float).reshape(len(sources), len(destinations))
+                # unreachable pairs are returned as null
+                mat[np.isnan(mat)] = np.inf
+                for (i, j), key in keys.items():
+                    self.cache.put(key, mat[i][j])
+                return mat
+            else:
+                return None
+        else:
+            return self.get_euclidean_matrix(sources, destinations) / self.cst_speed
+
+    # run func(*args) for each args in args_list, concurrently if the client is enabled
+    # and the queries go to the routing server; returns the results in order
+    # if given, cached(*args) returns the result if it is known without a call (or None), so that only
+    # the queries that need the routing server are sent to the pool, and none at all if they are all cached
+    def gather(self, func, args_list, cached=None):
+        if self.client is None or not IS_ROAD_ENABLED or len(args_list) <= 1:
+            return [func(*args) for args in args_list]
+        if cached is None:
+            return self.client.gather(func, args_list)
+        results = [cached(*args) for args in args_list]
+        missing = [k for k, res in enumerate(results) if res is None]
+        if len(missing) == 1:
+            results[missing[0]] = func(*args_list[missing[0]])
+        elif len(missing) > 1:
+            for k, res in zip(missing, self.client.gather(func, [args_list[k] for k in missing])):
+                results[k] = res
+        return results
+
+    # get the cached distance and duration from origin to destination, or None if they are not cached in memory
+    def get_cached_distance_duration(self, olng, olat, dlng, dlat):
+        key = self.cache.get_key("dd", olng, olat, dlng, dlat)
+        return self.cache.get(key) if key in self.cache else None
+
+    # get the durations of a list (or n x 4 array) of (olng, olat, dlng, dlat)
+    def get_durations(self, ods):
+        if IS_ROAD_ENABLED:
+            return [dd[1] if dd is not None else None for dd in self.get_distances_durations(ods)]
+        else:
+            return self.get_distances(ods) / self.cst_speed
+
+    # get the distances of a list (or n x 4 array) of (olng, olat, dlng, dlat)
+    def get_distances(self, ods):
+        if IS_ROAD_ENABLED:
+            return [dd[0] if dd is not None else None for dd in self.get_distances_durations(ods)]
+        else:
+            ods = np.asarray(ods, dtype=float).reshape(-1, 4)
+            return self.get_euclidean_distance(ods[:, 0], ods[:, 1], ods[:, 2], ods[:, 3])
+
+    # get the (distance, duration) pairs of a list of (olng, olat, dlng, dlat), with the road network enabled
+    def get_distances_durations(self, ods):
+        return self.gather(self.get_distance_duration, ods, cached=self.get_cached_distance_duration)
+
+
+class OsrmEnginePool(OsrmEngine):
+    """
+    OsrmEnginePool runs several routing servers on consecutive ports and distributes the calls among them
+    Attributes:
+        n_server: number of routing servers
+        ports: ports of the routing servers, starting from gport
+        policy: "rr" for round robin, "ll" for least loaded (fewest calls in flight)
+        shared: if true, the map is loaded once into shared memory by osrm-datastore and all servers read it
+        store_loc: path of the osrm-datastore executable
+        procs: process handles of the routing servers
+        inflight: number of calls in flight on each routing server
+        next: the routing server the next call is sent to in round robin
+    """
+    def __init__(self,
+                 exe_loc,
+                 map_loc,
+                 n_server = 4,
+                 policy = "ll",
+                 shared = True,
+                 **kwargs):
+        self.n_server = n_server
+        self.policy = policy
+        self.shared = shared
+        self.store_loc = os.path.join(os.path.dirname(exe_loc), "osrm-datastore")
+        if self.shared and not os.path.isfile(self.store_loc):
+            raise Exception("Could not find the shared memory loader at %s" % self.store_loc)
+        self.procs = [None] * n_server
+        self.inflight = [0] * n_server
+        self.next = 0
+        # the default connection pool should serve all servers at once
+        kwargs.setdefault("pool_size", 10 * n_server)
+        kwargs.setdefault("max_inflight", 8 * n_server)
+        super().__init__(exe_loc, map_loc, **kwargs)
+        self.ports = [self.gport + k for k in range(n_server)]
+
+    # kill the routing servers started by this pool, or any running routing server if none was started
+    def kill_server(self):
+        if all(p is None for p in self.procs):
+            super().kill_server()
+            return
+        for k in range(self.n_server):
+            self.kill_instance(k)
+
+    # start the routing servers, after loading the map into shared memory if needed
+    def start_server(self):
+        self.check_version()
+        if self.check_server():
+            raise Exception("osrm-routed already running")
+        stime = time.time()
+        if self.shared:
+            p = Popen([self.store_loc, self.map_loc], stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+            if p.wait() != 0:
+                raise Exception("Map could not be loaded into shared memory")
+        # launch all servers first, so that they load in parallel
+        for k in range(self.n_server):
+            self.launch_instance(k)
+        for k in range(self.n_server):
+            self.wait_for_server(self.ports[k], proc=self.procs[k])
+        self.t_start = time.time() - stime
+        print( "%d routing servers \"http://%s:%d-%d\" start running in %.2f s" % (
+            self.n_server, self.ghost, self.ports[0], self.ports[-1], self.t_start) )
+
+    # launch the process of the k-th routing server
+    def launch_instance(self, k):
+        cmd = [self.exe_loc, '-i', self.ghost, '-p', str(self.ports[k])]
+        cmd.extend(['-s'] if self.shared else [self.map_loc])
+        self.procs[k] = Popen(cmd, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+
+    # start the k-th routing server
+    def start_instance(self, k):
+        self.launch_instance(k)
+        t = self.wait_for_server(self.ports[k], proc=self.procs[k])
+        print( "The routing server \"http://%s:%d\" starts running in %.2f s" % (self.ghost, self.ports[k], t) )
+
+    # kill the k-th routing server
+    def kill_instance(self, k):
+        if self.procs[k] is None:
+            return
+        self.stop_process(self.procs[k])
+        self.procs[k] = None
+        self.wait_for_server(self.ports[k], up=False)
+        print( "The routing server \"http://%s:%d\" is killed" % (self.ghost, self.ports[k]) )
+
+    # restart the routing server on the given port, or all of them if port is None
+    def restart_server(self, port=None):
+        if port is None or port not in self.ports:
+            self.kill_server()
+            self.start_server()
+        else:
+            k = self.ports.index(port)
+            self.kill_instance(k)
+            self.start_instance(k)
+
+    # pick the server for the next call, following the distribution policy
+    def acquire_server(self):
+        with self.lock:
+            if self.policy == "rr":
+                k = self.next
+                self.next = (self.next + 1) % self.n_server
+            else:
+                k = int(np.argmin(self.inflight))
+            self.inflight[k] += 1
+        return (self.ghost, self.ports[k])
+
+    def release_server(self, server):
+        with self.lock:
+            self.inflight[self.ports.index(server[1])] -= 1
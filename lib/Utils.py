@@ -18,32 +18,21 @@ from lib.Env import *
 
 # print and save results
 def print_results(model, runtime):
-	count_reqs = 0
-	count_reqs_ond = 0
-	count_reqs_adv = 0
-	count_served = 0
-	count_served_ond = 0
-	count_served_adv = 0
-	wait_time_ond = 0.0
-	wait_time_adv = 0.0
-	in_veh_time = 0.0
-	detour_factor = 0.0
-
 	# analyze requests whose earliest pickup time is within the period of study
-	for req in model.reqs:
-		if req.Cep >= T_WARM_UP and req.Cep <= T_WARM_UP+T_STUDY:
-			count_reqs += 1
-			count_reqs_ond += 1 if req.OnD else 0
-			count_reqs_adv += 0 if req.OnD else 1
-			# count as "served" only when the request is complete, i.e. the dropoff time is not -1
-			if not np.isclose(req.Td, -1.0):
-				count_served += 1
-				count_served_ond += 1 if req.OnD else 0
-				count_served_adv += 0 if req.OnD else 1
-				wait_time_ond += (req.Tp - req.Cep) if req.OnD else 0
-				wait_time_adv += 0 if req.OnD else (req.Tp - req.Cep)
-				in_veh_time += (req.Td - req.Tp)
-				detour_factor += req.D
+	reqs = model.reqs.get_columns(T_WARM_UP, T_WARM_UP+T_STUDY)
+	ond = reqs["OnD"]
+	# count as "served" only when the request is complete, i.e. the dropoff time is not -1
+	served = ~np.isclose(reqs["Td"], -1.0)
+	count_reqs = len(reqs)
+	count_reqs_ond = int(np.sum(ond))
+	count_reqs_adv = count_reqs - count_reqs_ond
+	count_served = int(np.sum(served))
+	count_served_ond = int(np.sum(served & ond))
+	count_served_adv = count_served - count_served_ond
+	wait_time_ond = float(np.sum((reqs["Tp"] - reqs["Cep"])[served & ond]))
+	wait_time_adv = float(np.sum((reqs["Tp"] - reqs["Cep"])[served & ~ond]))
+	in_veh_time = float(np.sum((reqs["Td"] - reqs["Tp"])[served]))
+	detour_factor = float(np.sum(reqs["D"][served]))
 	if not count_served == 0:
 		in_veh_time /= count_served
 		detour_factor /= count_served
@@ -64,20 +53,14 @@ def print_results(model, runtime):
 		service_rate_adv = 100.0 * count_served_adv / count_reqs_adv
 	
 	# vehicle performance
-	veh_service_dist = 0.0
-	veh_service_time = 0.0
-	veh_rebl_dist = 0.0
-	veh_rebl_time = 0.0
-	veh_load_by_dist = 0.0
-	veh_load_by_time = 0.0
-	for veh in model.vehs:
-		veh_service_dist += veh.Ds
-		veh_service_time += veh.Ts
-		veh_rebl_dist += veh.Dr
-		veh_rebl_time += veh.Tr
-		if not veh.Ds + veh.Dr == 0:
-			veh_load_by_dist += veh.Ld / (veh.Ds + veh.Dr)
-		veh_load_by_time += veh.Lt / T_STUDY
+	fleet = model.fleet
+	veh_service_dist = np.sum(fleet.Ds)
+	veh_service_time = np.sum(fleet.Ts)
+	veh_rebl_dist = np.sum(fleet.Dr)
+	veh_rebl_time = np.sum(fleet.Tr)
+	dist = fleet.Ds + fleet.Dr
+	veh_load_by_dist = np.sum(fleet.Ld[dist != 0] / dist[dist != 0])
+	veh_load_by_time = np.sum(fleet.Lt / T_STUDY)
 	veh_service_dist /= model.V
 	veh_service_time /= model.V
 	veh_service_time_percent = 100.0 * veh_service_time / T_STUDY
@@ -97,6 +80,8 @@ def print_results(model, runtime):
 	print("  - assignment method: %s, interval: %.1f s" % (MET_REOPT, INT_ASSIGN))
 	print("  - reoptimization method: %s, interval: %.1f s" % (MET_REOPT, INT_REOPT))
 	print("  - rebalancing method: %s, interval: %.1f s" % (MET_REBL, INT_REBL))
+	print("  - time budgets hit: assignment %d times, reoptimization %d times, rebalancing %d times" % (
+		model.n_hit["assign"], model.n_hit["reopt"], model.n_hit["rebl"]))
 	print("simulation results:")
 	print("  - requests:")
 	print("    + service rate: %.1f%% (%d/%d)" % (service_rate, count_served, count_reqs))
@@ -128,11 +113,10 @@ def print_results(model, runtime):
 	f = open('output/requests.csv', 'w')
 	writer = csv.writer(f)
 	writer.writerow(["id", "olng", "olat", "dlng", "dlat", "Ts", "OnD", "Tr", "Cep", "Tp", "Td", "WT", "VT", "D"])
-	for req in model.reqs:
-		if req.Cep >= T_WARM_UP and req.Cep <= T_WARM_UP+T_STUDY:
-			row = [req.id, req.olng, req.olat, req.dlng, req.dlat, req.Ts, req.OnD, req.Tr, req.Cep, req.Tp, req.Td,
-			 req.Tp-req.Cep if req.Tp >= 0 else -1, req.Td-req.Tp if req.Td >= 0 else -1, req.D]
-			writer.writerow(row)
+	for req in reqs:
+		row = [req["id"], req["olng"], req["olat"], req["dlng"], req["dlat"], req["Ts"], req["OnD"], req["Tr"], req["Cep"], req["Tp"], req["Td"],
+		 req["Tp"]-req["Cep"] if req["Tp"] >= 0 else -1, req["Td"]-req["Tp"] if req["Td"] >= 0 else -1, req["D"]]
+		writer.writerow(row)
 	f.close()
 
 # animation
@@ -2,6 +2,7 @@ import time
 
 from lib.Utils import *
 from lib.OsrmEngine import *
+from lib.GraphEngine import *
 from lib.Agents import *
 from lib.Demand import *
 from lib.Constants import *
@@ -14,10 +15,15 @@ if __name__ == "__main__":
 	# path of the road network file that the routing server uses
 	map_loc = './osrm-backend-5.11.0/boston_massachusetts.osm.pbf'
 
+	# path of the routing cache shared across simulation runs
+	cache_loc = './output/routing_cache.db'
+
 	# if road network is enabled, initialize the routing server
 	# otherwise, use Euclidean distance
-	osrm = OsrmEngine(exe_loc, map_loc)
+	osrm = OsrmEngine(exe_loc, map_loc, cache_file=cache_loc)
 	osrm.start_server()
+	# alternatively, route in process on a graph built from an OpenStreetMap extract, with no routing server
+	# osrm = GraphEngine('./boston_massachusetts.osm', cache_file=cache_loc)
 
 	# define the environment for the Deep Q Network
 	env = RebalancingEnv( Model(DMD_MAT, DMD_VOL, V=FLEET_SIZE, K=VEH_CAPACITY), penalty=-0 )
@@ -47,7 +53,8 @@ if __name__ == "__main__":
 			# frames record the states of the AMoD model for animation purpose
 			frames = []
 			# initialize the AMoD model
-			model = Model(DMD_MAT, DMD_VOL, dqn=dqn, V=FLEET_SIZE, K=VEH_CAPACITY, assign=MET_ASSIGN, reopt=MET_REOPT, rebl=MET_REBL)
+			model = Model(DMD_MAT, DMD_VOL, dqn=dqn, V=FLEET_SIZE, K=VEH_CAPACITY, assign=MET_ASSIGN, reopt=MET_REOPT, rebl=MET_REBL, n_worker=N_WORKER,
+				b_assign=B_ASSIGN, b_reopt=B_REOPT, b_rebl=B_REBL)
 			# start time
 			stime = time.time()
 			# dispatch the system for T_TOTAL seconds, at the interval of INT_ASSIGN
@@ -68,3 +75,10 @@ if __name__ == "__main__":
 
 			# output the simulation results and save data
 			print_results(model, runtime)
+			osrm.flush_cache()
+			stats = osrm.get_call_stats()
+			print("routing server: %d calls, %d fails, %d timeouts, mean latency %.2f ms, max latency %.2f ms" % (
+				stats["calls"], stats["fails"], stats["timeouts"], 1000*stats["mean_latency"], 1000*stats["max_latency"]))
+			stats = osrm.get_cache_stats()
+			print("routing cache: %d entries, %d hits (%d from disk), %d misses, hit rate %.1f%%, %d disk writes dropped" % (
+				stats["entries"], stats["hits"], stats["disk_hits"], stats["misses"], 100*stats["hit_rate"], stats["disk_dropped"]))
@@ -0,0 +1,55 @@
+"""
+shared fixtures of the tests, which simulate the system without the road network (no routing server needed)
+"""
+
+import os
+import sys
+import io
+import contextlib
+import copy
+import time
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lib.Constants
+import lib.OsrmEngine
+import lib.Agents
+from lib.OsrmEngine import OsrmEngine
+from lib.Agents import Model
+from lib.Demand import M_MIT
+
+
+# a routing engine with the road network disabled
+# the modules import the constants by name, so the switch is turned off in each of them
+@pytest.fixture
+def osrm(tmp_path, monkeypatch):
+    for mod in (lib.Constants, lib.OsrmEngine, lib.Agents):
+        monkeypatch.setattr(mod, "IS_ROAD_ENABLED", False)
+    exe_loc = tmp_path / "osrm-routed"
+    map_loc = tmp_path / "map.osrm"
+    exe_loc.write_text("")
+    map_loc.write_text("")
+    # no server listens on port 1, so the engine does not try to kill one
+    return OsrmEngine(str(exe_loc), str(map_loc), gport=1, max_inflight=1)
+
+
+# dispatch a seeded model for T seconds, and return it with its worker pool shut down
+def simulate(osrm, T, seed=0, V=50, D=600, **kwargs):
+    np.random.seed(seed)
+    model = Model(M_MIT, D, V=V, K=4, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for t in range(0, T, 30):
+            model.dispatch_at_time(osrm, t)
+    if model.pool is not None:
+        model.pool.shutdown()
+        model.pool = None
+    return model
+
+
+# the outcome of a simulation: the pickup and dropoff times of all requests, and the routes of the vehicles
+def get_outcome(model):
+    reqs = [(req.id, req.Tp, req.Td) for req in model.reqs]
+    routes = [[(leg.rid, leg.pod) for leg in veh.route] for veh in model.vehs]
+    return reqs, routes
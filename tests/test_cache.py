@@ -0,0 +1,54 @@
+"""
+tests of the caches of routing results
+"""
+
+import sqlite3
+from conftest import *
+from lib.OsrmEngine import DiskCache, LruCache
+
+
+# the least recently used entry is evicted when the cache is full
+def test_lru_eviction():
+    cache = LruCache(max_size=2)
+    cache.put(("d", 0, 0, 1, 1), 1.0)
+    cache.put(("d", 0, 0, 2, 2), 2.0)
+    assert cache.get(("d", 0, 0, 1, 1)) == 1.0
+    cache.put(("d", 0, 0, 3, 3), 3.0)
+    assert ("d", 0, 0, 2, 2) not in cache
+    assert cache.get(("d", 0, 0, 2, 2)) is None
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+# the results written by one run are read by the next one on the same map only, warm-started in memory
+# up to the size of the cache and looked up on disk beyond it
+def test_disk_roundtrip(tmp_path):
+    path = str(tmp_path / "cache.db")
+    disk = DiskCache(path, "map")
+    cache = LruCache(disk=disk)
+    cache.put(("dd", 0, 0, 1, 1), (10.0, 2.0))
+    cache.put(("dd", 0, 0, 2, 2), (20.0, 4.0))
+    disk.close()
+    cache = LruCache(max_size=1, disk=DiskCache(path, "map"))
+    assert len(cache) == 1
+    assert cache.get(("dd", 0, 0, 1, 1)) == (10.0, 2.0)
+    assert cache.get(("dd", 0, 0, 2, 2)) == (20.0, 4.0)
+    assert cache.disk_hits == 1
+    assert LruCache(disk=DiskCache(path, "other")).get(("dd", 0, 0, 1, 1)) is None
+
+
+# the writes are dropped rather than blocking while another process holds the write lock
+def test_disk_locked(tmp_path):
+    path = str(tmp_path / "cache.db")
+    disk = DiskCache(path, "map", commit_every=1000, busy_timeout=0.01)
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    disk.put(("d", 0, 0, 1, 1), 1.0)
+    disk.flush()
+    assert disk.n_dropped == 1
+    other.execute("ROLLBACK")
+    disk.put(("d", 0, 0, 1, 1), 1.0)
+    disk.flush()
+    assert disk.get(("d", 0, 0, 1, 1)) == 1.0
+    other.close()
+    disk.close()
@@ -0,0 +1,41 @@
+"""
+tests of the columnar states of the vehicles and of the requests
+"""
+
+from conftest import *
+from lib.Agents import Req, ReqStore
+
+
+# the locations read ahead on the timelines are those the vehicles are moved to
+def test_locations_at_time_same_as_moved(osrm):
+    model = simulate(osrm, 600, V=20)
+    for T in (600, 617.5, 660, 3600):
+        lng, lat, n = model.fleet.get_locations_at_time(model.vehs, T)
+        model.fleet.move_to_time(model.vehs, T)
+        assert np.allclose(lng, [veh.lng for veh in model.vehs])
+        assert np.allclose(lat, [veh.lat for veh in model.vehs])
+        assert n.tolist() == [veh.n for veh in model.vehs]
+    assert all(len(veh.route) == 0 and veh.n == 0 for veh in model.vehs)
+
+
+# the requests are the same whether kept as objects or rebuilt from the columns once finished
+def test_req_store(osrm):
+    store = ReqStore()
+    reqs = []
+    for rid in range(ReqStore.CHUNK + 2):
+        req = Req(osrm, rid, 10.0 * rid, -71.1, 42.3, -71.05, 42.35 + rid * 1e-6, OnD=rid % 2 == 0, Ts=300.0)
+        store.append(req)
+        reqs.append(req)
+    assert len(store) == len(reqs)
+    assert store[-1] is reqs[-1]
+    reqs[1].Tp = 20.0
+    reqs[1].Td = 400.0
+    store.finish(1)
+    req = store[1]
+    assert req is not reqs[1]
+    assert (req.id, req.Tr, req.OnD, req.Clp, req.Tp, req.Td) == (1, 10.0, False, reqs[1].Clp, 20.0, 400.0)
+    t0 = ReqStore.CHUNK * 10.0
+    assert store.get_columns(t0)["id"].tolist() == [req.id for req in reqs if req.Cep >= t0]
+    assert store.get_columns()["Cep"].tolist() == [req.Cep for req in reqs]
+    with pytest.raises(IndexError):
+        store[len(reqs)]
@@ -0,0 +1,60 @@
+"""
+tests of the insertion heuristics
+"""
+
+from conftest import *
+
+
+# the parallel insertion heuristics assign the same vehicles at the same times as the serial one
+def test_parallel_same_as_serial(osrm):
+    serial = get_outcome(simulate(osrm, 900, V=100, D=1000, n_worker=1))
+    for n_worker in (2, 3):
+        assert get_outcome(simulate(osrm, 900, V=100, D=1000, n_worker=n_worker)) == serial
+
+
+# on the rounding of additional costs, the best vehicle is picked by the same test as in the serial insertion:
+# vehicle 1 adds 6.9 - 3.8 = 3.1000000000000005 against 4.5 - 1.4 = 3.1 for vehicle 0, but its route costs
+# no more than 3.8 + 3.1, so the later vehicle wins the tie as it does serially
+def test_best_vehicle_tie(osrm):
+    model = Model(M_MIT, 60, V=2, K=4)
+    model.vehs[0].c = 1.4
+    model.vehs[1].c = 3.8
+    ins = {0: (4.5 - 1.4, [], 4.5), 1: (6.9 - 3.8, [], 6.9)}
+    assert ins[1][0] > ins[0][0]
+    assert model.get_best_vehicle(ins) == 1
+    assert model.get_best_vehicle({}) is None
+
+
+
+# with a budget running out before the workers return, the insertions they found are still committed,
+# so that requests are served instead of going back to the queue at every interval
+def test_parallel_budget_progress(osrm):
+    model = simulate(osrm, 900, V=100, D=1000, n_worker=2, b_assign=0.0005)
+    assert model.n_hit["assign"] > 0
+    assert sum(req.Tp >= 0 for req in model.reqs) > len(model.reqs) / 2
+
+
+# without the road network, no duration table is built up front and no lower bound is computed
+def test_no_road_reads_durations_lazily(osrm, monkeypatch):
+    def get_duration_matrix(*args, **kwargs):
+        raise AssertionError("duration table built without the road network")
+    monkeypatch.setattr(osrm, "get_duration_matrix", get_duration_matrix)
+    model = simulate(osrm, 600)
+    assert model.n_cand == 0
+    assert sum(req.Tp >= 0 for req in model.reqs) > 0
+
+
+# the vehicles in a radius are those within it by the distance of each vehicle on its own
+def test_vehicles_in_radius(osrm):
+    model = simulate(osrm, 300)
+    req = model.reqs[0]
+    for r in (0.0, 500.0, 2000.0, np.inf):
+        vehs = [veh for veh in model.vehs if osrm.get_euclidean_distance(veh.lng, veh.lat, req.olng, req.olat) <= r]
+        assert model.get_vehicles_in_radius(osrm, req.olng, req.olat, r) == vehs
+    assert model.get_vehicles_in_radius(osrm, req.olng, req.olat, -1.0) == []
+
+
+# a budget that is never reached does not change the result
+def test_unreached_budget_same_result(osrm):
+    assert get_outcome(simulate(osrm, 600, b_assign=1e6)) == get_outcome(simulate(osrm, 600))
+    assert get_outcome(simulate(osrm, 600, n_worker=2, b_assign=1e6)) == get_outcome(simulate(osrm, 600, n_worker=2))
@@ -0,0 +1,70 @@
+"""
+tests of the reoptimization by simulated annealing and large neighborhood search
+"""
+
+from conftest import *
+
+
+# the total cost of the vehicles and the stops on their routes
+def get_state(model):
+    c = sum(veh.c for veh in model.vehs)
+    stops = sorted((leg.rid, leg.pod) for veh in model.vehs for leg in veh.route if leg.rid != -1)
+    return c, stops
+
+
+# reoptimize the state of a seeded simulation with a budget for the reoptimization
+def reoptimize(osrm, reopt, n_worker=1, budget=None):
+    model = simulate(osrm, 600, n_worker=n_worker)
+    before = get_state(model)
+    np.random.seed(1)
+    model.reopt = reopt
+    model.start_budget(budget)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if reopt == "hsa":
+            model.simulated_annealing(osrm)
+        else:
+            model.large_neighborhood_search(osrm)
+    if model.pool is not None:
+        model.pool.shutdown()
+        model.pool = None
+    return before, get_state(model)
+
+
+# a reoptimization keeps all stops on the routes and never raises the total cost
+@pytest.mark.parametrize("reopt, n_worker", [("hsa", 1), ("hsa", 2), ("lns", 1)])
+def test_reopt_lowers_cost(osrm, reopt, n_worker):
+    (c, stops), (c_, stops_) = reoptimize(osrm, reopt, n_worker)
+    assert stops_ == stops
+    assert c_ <= c + 1e-6
+
+
+# the same seed gives the same reoptimization
+@pytest.mark.parametrize("reopt, n_worker", [("hsa", 1), ("hsa", 2), ("lns", 1)])
+def test_reopt_seeded(osrm, reopt, n_worker):
+    assert reoptimize(osrm, reopt, n_worker) == reoptimize(osrm, reopt, n_worker)
+
+
+# a reoptimization out of budget from the start changes nothing
+def test_lns_out_of_budget(osrm):
+    before, after = reoptimize(osrm, "lns", budget=0.0)
+    assert after == before
+
+
+# a large neighborhood search costs about as much as simulated annealing on the same state
+# (it took 20 times as long with 100 moves per interval); the best of three runs is kept against noise
+def test_lns_runtime(osrm):
+    model = simulate(osrm, 600)
+    dts = {}
+    for reopt in ("hsa", "lns"):
+        dts[reopt] = np.inf
+        for i in range(3):
+            model_ = copy.deepcopy(model)
+            model_.start_budget(None)
+            t = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if reopt == "hsa":
+                    model_.simulated_annealing(osrm)
+                else:
+                    model_.large_neighborhood_search(osrm)
+            dts[reopt] = min(dts[reopt], time.time() - t)
+    assert dts["lns"] < 4 * dts["hsa"]
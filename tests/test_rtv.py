@@ -0,0 +1,13 @@
+"""
+tests of the assignment of shared trips (rtv)
+"""
+
+from conftest import *
+
+
+# the trips are matched to cover the most requests, where taking the cheapest largest trip first covers only two
+def test_match_trips(osrm):
+    model = Model(M_MIT, 60, V=2, K=4)
+    trips = {(0, (0, 1)): (1.0, []), (0, (0,)): (5.0, []), (1, (1, 2)): (2.0, [])}
+    assert sorted(model.match_trips(trips, 3)) == [(0, (0,)), (1, (1, 2))]
+    assert model.match_trips({}, 3) == []